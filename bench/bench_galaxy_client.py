@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Compare RemoteGalaxy API calls made with a new connection per request (the
+module level requests.get used before) against the shared keep-alive
+session, using a local stub of the Galaxy API. The stub can add latency and
+answer a fraction of requests with 503 to exercise the retries.
+
+    python bench/bench_galaxy_client.py -n 2000 --fail-rate 0.05
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import requests
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gwftool.warpdrive import RemoteGalaxy
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency, fail_rate):
+        HTTPServer.__init__(self, address, StubHandler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.connections = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    #send each response in one write, otherwise delayed ACKs stall keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.fail_rate:
+            self.reply(503, {"err_msg" : "unavailable"})
+            return
+        path = self.path.split("?")[0].rstrip("/").split("/")
+        self.reply(200, { "id" : path[-1], "history_id" : path[-3] if len(path) > 3 else None, "state" : "ok" })
+
+    def reply(self, code, data):
+        text = json.dumps(data)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+
+class PlainGalaxy(RemoteGalaxy):
+    """
+    The pre-session client: one connection per call, no retries
+    """
+    def get(self, path, params={}):
+        params = dict(params)
+        params['key'] = self.api_key
+        return requests.get(self.url + path, params=params).json()
+
+
+def run(client, server, calls):
+    server.connections = 0
+    server.requests = 0
+    errors = 0
+    start = time.time()
+    for i in range(calls):
+        try:
+            meta = client.get_hda("h1", "d%d" % (i))
+            if meta.get('state', None) != 'ok':
+                errors += 1
+        except (ValueError, requests.exceptions.RequestException):
+            errors += 1
+    wall = time.time() - start
+    return {
+        'wall' : wall,
+        'rate' : calls / wall,
+        'connections' : server.connections,
+        'requests' : server.requests,
+        'errors' : errors
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--calls", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the stub takes to answer")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--backoff", type=float, default=0.01)
+    args = parser.parse_args(args)
+
+    server = StubServer(("127.0.0.1", 0), args.latency, args.fail_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d" % (server.server_address[1])
+
+    results = {}
+    try:
+        results['plain'] = run(PlainGalaxy(url, "key"), server, args.calls)
+        results['session'] = run(RemoteGalaxy(url, "key", retries=args.retries, backoff=args.backoff), server, args.calls)
+    finally:
+        server.shutdown()
+
+    print "%d calls, %.3fs latency, %.0f%% 503s" % (args.calls, args.latency, args.fail_rate * 100)
+    print "%-8s %10s %10s %12s %9s %7s" % ("client", "wall_s", "calls/s", "connections", "requests", "errors")
+    for name in ["plain", "session"]:
+        r = results[name]
+        print "%-8s %10.3f %10.1f %12d %9d %7d" % (name, r['wall'], r['rate'], r['connections'], r['requests'], r['errors'])
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
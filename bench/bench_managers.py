@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Compare the scheduling overhead of thread-per-job Runners (LocalManager)
+against Runners driven from a single polling loop (PollingManager) at high
+concurrency. Jobs are plain `sleep` processes rather than containers, so the
+numbers measure gwftool's own overhead, not docker's.
+
+    python bench/bench_managers.py -n 2000 -s 2
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gwftool.engine import Runner
+
+
+class BenchTool(object):
+    tool_id = "bench"
+
+    def get_docker_image(self):
+        return None
+
+    def tool_dir(self):
+        return "/"
+
+
+class BenchRunner(Runner):
+    def get_mounts(self):
+        return []
+
+    def docker_command(self, mounts, script_path):
+        return ["sleep", str(self.script)]
+
+    def kill_container(self):
+        pass
+
+
+def run(count, seconds, threaded, poll_interval, workdir):
+    jobs = []
+    for i in range(count):
+        jobdir = os.path.join(workdir, "%s_%d" % ("thread" if threaded else "poll", i))
+        os.mkdir(jobdir)
+        jobs.append(BenchRunner(BenchTool(), i, jobdir, str(seconds), {}, {}, no_net=True, threaded=threaded))
+
+    cpu_start = os.times()
+    start = time.time()
+    for j in jobs:
+        j.start()
+    launched = time.time() - start
+    peak_threads = threading.active_count()
+    running = list(jobs)
+    while len(running):
+        peak_threads = max(peak_threads, threading.active_count())
+        running = list(j for j in running if j.isAlive())
+        if len(running):
+            time.sleep(poll_interval)
+    wall = time.time() - start
+    cpu_end = os.times()
+    failed = len(list(j for j in jobs if j.return_code != 0))
+    return {
+        'launch' : launched,
+        'wall' : wall,
+        'overhead' : wall - seconds,
+        'cpu' : (cpu_end[0] - cpu_start[0]) + (cpu_end[1] - cpu_start[1]),
+        'threads' : peak_threads,
+        'failed' : failed
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--jobs", type=int, default=1000)
+    parser.add_argument("-s", "--seconds", type=float, default=2.0)
+    parser.add_argument("-p", "--poll-interval", type=float, default=0.1)
+    args = parser.parse_args(args)
+
+    workdir = tempfile.mkdtemp(prefix="gwftool_bench_")
+    results = {}
+    try:
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            for name, threaded in [("thread", True), ("poll", False)]:
+                results[name] = run(args.jobs, args.seconds, threaded, args.poll_interval, workdir)
+        finally:
+            sys.stdout = stdout
+    finally:
+        shutil.rmtree(workdir)
+
+    print "%d jobs of %.1f seconds" % (args.jobs, args.seconds)
+    print "%-8s %10s %10s %10s %10s %8s %7s" % ("manager", "launch_s", "wall_s", "overhead_s", "cpu_s", "threads", "failed")
+    for name in ["thread", "poll"]:
+        r = results[name]
+        print "%-8s %10.3f %10.3f %10.3f %10.3f %8d %7d" % (name, r['launch'], r['wall'], r['overhead'], r['cpu'], r['threads'], r['failed'])
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+Load test of WorkflowRunner task throughput against a local stub of the
+Galaxy API, which answers library pastes and workflow invocations after a
+configurable latency and reports pasted datasets as loaded after a delay.
+Each stub handles at most --capacity pastes or invocations at a time, like
+the job handlers of one Galaxy. Each run submits N tasks, each with its own
+input files, and reports the tasks per minute uploaded and invoked for
+every combination of worker count and number of Galaxy instances.
+
+    python bench/bench_workflow_runner.py -n 40 -w 1 -w 8 -g 1 -g 4
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+import threading
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gwftool import runner
+
+
+class StubGalaxy(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency, load_delay, capacity):
+        HTTPServer.__init__(self, address, StubHandler)
+        self.latency = latency
+        self.load_delay = load_delay
+        self.handlers = threading.Semaphore(capacity)
+        self.lock = threading.Lock()
+        #dataset id -> time it was pasted
+        self.datasets = {}
+        self.invocations = 0
+
+    def dataset(self, i):
+        with self.lock:
+            pasted = self.datasets.get(i, None)
+        if pasted is None:
+            return {"id" : i, "state" : "error"}
+        return {"id" : i, "state" : "ok" if time.time() - pasted >= self.load_delay else "queued"}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/").split("/")[1:]
+        if path == ["api", "libraries"]:
+            self.reply([{"id" : "L1", "name" : "Imported"}])
+        elif path == ["api", "libraries", "L1", "contents"]:
+            self.reply([{"id" : "F1", "name" : "/", "type" : "folder"}])
+        elif path[:3] == ["api", "libraries", "L1"] and len(path) == 5:
+            self.reply(self.server.dataset(path[4]))
+        elif path == ["api", "folders", "F1", "contents"]:
+            with self.server.lock:
+                ids = list(self.server.datasets)
+            self.reply({"folder_contents" : list(self.server.dataset(i) for i in ids)})
+        else:
+            self.reply({})
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        path = self.path.split("?")[0].rstrip("/").split("/")[1:]
+        if path == ["api", "libraries"]:
+            self.reply({"id" : "L1"})
+        elif path == ["api", "libraries", "L1", "contents"]:
+            with self.server.handlers:
+                time.sleep(self.server.latency)
+            out = []
+            for p in payload['filesystem_paths'].split("\n"):
+                i = uuid.uuid4().hex
+                with self.server.lock:
+                    self.server.datasets[i] = time.time()
+                out.append({"id" : i, "name" : os.path.basename(p)})
+            self.reply(out)
+        elif path == ["api", "workflows"]:
+            with self.server.handlers:
+                time.sleep(self.server.latency)
+            with self.server.lock:
+                self.server.invocations += 1
+                n = self.server.invocations
+            self.reply({"history" : "H%d" % (n), "uuid" : uuid.uuid4().hex, "steps" : [
+                {"workflow_step_label" : "out", "workflow_step_uuid" : "S1", "outputs" : {"output" : {"id" : "D%d" % (n), "src" : "hda"}}}
+            ]})
+        else:
+            self.reply({})
+
+    def reply(self, data):
+        text = json.dumps(data)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+
+class BenchTarget(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class BenchDocStore(object):
+    def __init__(self, path):
+        self.path = path
+
+    def get_filename(self, target):
+        return os.path.join(self.path, target.id)
+
+    def get(self, id):
+        return {}
+
+
+class BenchInput(object):
+    def __init__(self, id):
+        self.id = id
+        self.uuid = str(uuid.uuid4())
+
+
+class BenchTask(object):
+    workflow = {"uuid" : "bench-workflow", "steps" : {"0" : {
+        "id" : 0, "uuid" : "S1", "type" : "tool", "label" : "out", "annotation" : "", "tool_id" : "bench",
+        "tool_state" : "{}", "outputs" : [{"name" : "output", "type" : "txt"}]
+    }}}
+
+    def to_dict(self):
+        return {"workflow" : self.workflow}
+
+    def get_workflow_request(self, uuid_ldda_map):
+        return {"workflow_id" : "bench-workflow", "ds_map" : uuid_ldda_map}
+
+
+class BenchJob(object):
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.task = BenchTask()
+        self.state = "waiting"
+        self.history = None
+
+    def get_inputs(self):
+        return self.inputs
+
+    def set_error(self, msg):
+        self.state = "error"
+
+
+def run(urls, tasks, inputs, workers, dispatch, workdir):
+    run_name = "w%d_g%d" % (workers, len(urls))
+    docs = os.path.join(workdir, "docs_%s" % (run_name))
+    os.mkdir(docs)
+    jobs = {}
+    for t in range(tasks):
+        job_inputs = {}
+        for i in range(inputs):
+            name = "%s_t%d_i%d" % (run_name, t, i)
+            with open(os.path.join(docs, name), "w") as handle:
+                handle.write(name)
+            job_inputs["input%d" % (i)] = BenchInput(name)
+        jobs["job%d" % (t)] = BenchJob(job_inputs)
+
+    r = runner.WorkflowRunner(docs, poll_min=0.1, workers=workers, docstore=BenchDocStore(docs), target_class=BenchTarget)
+    r.config = dict(r.config, urls=urls, api_key="key", dispatch=dispatch, library_index=os.path.join(workdir, "index_%s.json" % (run_name)))
+    r.ready = False
+    engine = threading.Thread(target=r.runEngine)
+    engine.daemon = True
+    engine.start()
+    while not r.ready:
+        if not engine.isAlive():
+            raise Exception("WorkflowRunner failed to start")
+        time.sleep(0.05)
+
+    start = time.time()
+    for job_id, job in jobs.items():
+        r.submit(job_id, job)
+    while len(r.active) < tasks:
+        time.sleep(0.02)
+    wall = time.time() - start
+    r.stop()
+    engine.join()
+    return {
+        'wall' : wall,
+        'rate' : tasks / wall * 60,
+        'errors' : len(list(j for j in jobs.values() if j.state == "error"))
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--tasks", type=int, default=40)
+    parser.add_argument("-i", "--inputs", type=int, default=3, help="Input files per task")
+    parser.add_argument("-w", "--workers", type=int, action="append", default=None)
+    parser.add_argument("-g", "--galaxies", type=int, action="append", default=None, help="Number of Galaxy instances")
+    parser.add_argument("--capacity", type=int, default=2, help="Concurrent pastes or invocations one Galaxy handles")
+    parser.add_argument("--dispatch", default="hash", choices=["hash", "least"])
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds the stub takes to paste or invoke")
+    parser.add_argument("--load-delay", type=float, default=0.5, help="Seconds until pasted datasets are loaded")
+    args = parser.parse_args(args)
+    if args.workers is None:
+        args.workers = [1, 4, 8]
+    if args.galaxies is None:
+        args.galaxies = [1]
+
+    servers = []
+    for i in range(max(args.galaxies)):
+        server = StubGalaxy(("127.0.0.1", 0), args.latency, args.load_delay, args.capacity)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+    urls = list("http://127.0.0.1:%d" % (s.server_address[1]) for s in servers)
+
+    workdir = tempfile.mkdtemp(prefix="gwftool_bench_")
+    results = {}
+    try:
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            for g in args.galaxies:
+                for w in args.workers:
+                    results[(w, g)] = run(urls[:g], args.tasks, args.inputs, w, args.dispatch, workdir)
+        finally:
+            sys.stdout = stdout
+    finally:
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(workdir)
+
+    print "%d tasks of %d inputs, %.2fs API latency, %.2fs load delay, capacity %d per Galaxy, %s dispatch" % (args.tasks,
+        args.inputs, args.latency, args.load_delay, args.capacity, args.dispatch)
+    print "%-8s %8s %10s %12s %7s" % ("workers", "galaxies", "wall_s", "tasks/min", "errors")
+    for g in args.galaxies:
+        for w in args.workers:
+            r = results[(w, g)]
+            print "%-8d %8d %10.3f %12.1f %7d" % (w, g, r['wall'], r['rate'], r['errors'])
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -6,34 +6,137 @@ import yaml
 import logging
 import argparse
 import tempfile
+import itertools
 
 from gwftool.workflow_io import GalaxyWorkflow
 from gwftool.tool_io import GalaxyTool, ToolBox
-from gwftool.engine import Engine, LocalManager
+from gwftool.engine import Engine, LocalManager, PollingManager, JobPolicy
+from gwftool.history import ToolHistory
+from gwftool.lease import LeaseDir
+from gwftool.hashing import FileHasher
+from gwftool.runlog import report_main
 
 
+def load_inputs(path):
+    with open(path) as handle:
+        inputs = yaml.load(handle.read())
+    
+    basedir = os.path.dirname(path)
+    for v in inputs.values():
+        #a list of Files, or a Directory, is a collection the steps using it are mapped over
+        for i in (v if isinstance(v, list) else [v]):
+            if isinstance(i, dict) and i.get('class', None) in ['File', 'Directory']:
+                i['path'] = os.path.abspath(os.path.join(basedir, i['path']))
+    return inputs
+
+
+def load_manifest(path):
+    """
+    A batch manifest maps set names to input files, or lists input files
+    (named after the file). Paths are relative to the manifest
+    """
+    with open(path) as handle:
+        manifest = yaml.load(handle.read())
+    if isinstance(manifest, list):
+        manifest = dict( (os.path.splitext(os.path.basename(p))[0], p) for p in manifest )
+    basedir = os.path.dirname(path)
+    out = []
+    for name in sorted(manifest):
+        out.append( (str(name), load_inputs(os.path.join(basedir, manifest[name]))) )
+    return out
+
+
+def load_sweep(path):
+    """
+    A sweep file maps step labels to tool parameters and the values to try
+    for each. Returns the overrides for every point of the grid
+    """
+    with open(path) as handle:
+        grid = yaml.load(handle.read())
+    axes = []
+    for label in sorted(grid):
+        for param in sorted(grid[label]):
+            values = grid[label][param]
+            if not isinstance(values, list):
+                values = [values]
+            axes.append( (label, param, values) )
+    points = []
+    for combo in itertools.product(*list(a[2] for a in axes)):
+        point = {}
+        for (label, param, values), v in zip(axes, combo):
+            point.setdefault(label, {})[param] = v
+        points.append(point)
+    return points
+
 
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
+    if len(args) and args[0] == "report":
+        return report_main(args[1:])
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--tooldir", action="append", default=[])
     parser.add_argument("-w", "--workdir", default="./")
     parser.add_argument("-o", "--outdir", default="./")
     parser.add_argument("--no-net", action="store_true", default=False)
     parser.add_argument("--dryrun", default=False, action="store_true")
+    parser.add_argument("--history", default=os.path.join(os.environ.get("HOME", "./"), ".gwftool", "history.json"),
+        help="File used to store per tool job measurements between runs")
+    parser.add_argument("--disk-watermark", default=None,
+        help="Defer jobs that would leave less than this much free space on the outdir or workdir (ie 20G or 5%%)")
+    parser.add_argument("--stream", action="append", default=[],
+        help="Tool ID that reads its inputs sequentially, single consumer inputs to it are passed through named pipes")
+    parser.add_argument("--fuse", action="store_true", default=False,
+        help="Run chains of single consumer steps that share a docker image in one container")
+    parser.add_argument("--pack", action="store_true", default=False,
+        help="Pack ready jobs that share a docker image into shared containers")
+    parser.add_argument("--retries", type=int, default=0, help="Times a failed job is retried")
+    parser.add_argument("--retry-backoff", type=float, default=5,
+        help="Seconds before the first retry, doubled for every following one")
+    parser.add_argument("--timeout", type=float, default=None, help="Wall clock seconds before a job's container is killed")
+    parser.add_argument("--tool-policy", default=None,
+        help="YAML/JSON file mapping tool IDs to their own retries, backoff and timeout")
+    parser.add_argument("--speculate", type=float, default=None,
+        help="Launch a duplicate of jobs running this many times past their tool's 95th percentile wall time")
+    parser.add_argument("--fail-fast", action="store_true", default=False,
+        help="Kill all running jobs and stop the workflow at the first failure")
+    parser.add_argument("--poll", action="store_true", default=False,
+        help="Drive all jobs from the scheduling loop instead of a thread per job")
+    parser.add_argument("--harvest-workers", type=int, default=4,
+        help="Threads used to move finished jobs' outputs into the outdir")
+    parser.add_argument("--batch", action="store_true", default=False,
+        help="inputs is a manifest of input files, the workflow is run on each set in the same engine")
+    parser.add_argument("--max-jobs", type=int, default=None, help="Maximum number of jobs running at once")
+    parser.add_argument("--sweep", default=None,
+        help="YAML/JSON file mapping step labels to parameters and lists of values, the workflow is run on every combination")
+    parser.add_argument("--lease-dir", default=None,
+        help="Directory shared by gwftool processes so identical jobs are only run by one of them")
+    parser.add_argument("--lease-timeout", type=float, default=60,
+        help="Seconds without a heartbeat before another process takes over a job")
+    parser.add_argument("--hash-workers", type=int, default=4, help="Threads used to compute file checksums")
+    parser.add_argument("--digest-cache", default=os.path.join(os.environ.get("HOME", "./"), ".gwftool", "digests"),
+        help="Directory used to cache file checksums between runs")
+    parser.add_argument("--run-log", default=None,
+        help="JSON lines log of the run's jobs and failures (default <outdir>/gwftool_run.jsonl), see gwftool report")
     parser.add_argument("workflow")
     parser.add_argument("inputs")
     
     args = parser.parse_args(args)
     
-    with open(args.inputs) as handle:
-        inputs = yaml.load(handle.read())
-    
-    basedir = os.path.dirname(args.inputs)
-    for i in inputs.values():
-        if isinstance(i, dict) and i.get('class', None) == 'File':
-            i['path'] = os.path.abspath(os.path.join(basedir, i['path']))
+    if args.batch:
+        input_sets = load_manifest(args.inputs)
+    else:
+        input_sets = [(None, load_inputs(args.inputs))]
+    overrides = {}
+    if args.sweep is not None:
+        points = load_sweep(args.sweep)
+        sweep_sets = []
+        for name, inputs in input_sets:
+            for i, point in enumerate(points):
+                point_name = "p%d" % (i) if name is None else "%s_p%d" % (name, i)
+                sweep_sets.append( (point_name, inputs) )
+                overrides[point_name] = point
+        input_sets = sweep_sets
     if not args.dryrun:
         workdir = os.path.abspath(tempfile.mkdtemp(dir=args.workdir, prefix="gwftool_"))
         os.chmod(workdir, 0o777)
@@ -46,9 +149,30 @@ def main(args=None):
         
     workflow = GalaxyWorkflow(ga_file=args.workflow)
     
-    manager = LocalManager(no_net=True)
-    engine = Engine(workdir=workdir, outdir=args.outdir, toolbox=toolbox, manager=manager)
-    engine.run_job(workflow, inputs, dryrun=args.dryrun)
+    history = ToolHistory(args.history)
+    policy = JobPolicy(retries=args.retries, backoff=args.retry_backoff, timeout=args.timeout)
+    tool_policies = {}
+    if args.tool_policy is not None:
+        with open(args.tool_policy) as handle:
+            for tool_id, data in yaml.load(handle.read()).items():
+                tool_policies[tool_id] = JobPolicy.from_dict(data, default=policy)
+    manager_class = PollingManager if args.poll else LocalManager
+    manager = manager_class(no_net=True, pack=args.pack, history=history, policy=policy, tool_policies=tool_policies)
+    leases = None
+    if args.lease_dir is not None:
+        leases = LeaseDir(args.lease_dir, timeout=args.lease_timeout)
+    engine = Engine(workdir=workdir, outdir=args.outdir, toolbox=toolbox, manager=manager,
+        history=history, disk_watermark=args.disk_watermark, stream_tools=args.stream, fuse=args.fuse,
+        speculate=args.speculate, fail_fast=args.fail_fast, harvest_workers=args.harvest_workers,
+        max_jobs=args.max_jobs, leases=leases, hasher=FileHasher(workers=args.hash_workers, cache_dir=args.digest_cache),
+        run_log=args.run_log)
+    if len(overrides):
+        #record which parameters went into each point's output directory
+        with open(os.path.join(args.outdir, "sweep.json"), "w") as handle:
+            handle.write(json.dumps(overrides, indent=4, sort_keys=True))
+    if not engine.run_batch(workflow, input_sets, dryrun=args.dryrun, overrides=overrides):
+        return 1
+    return 0
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv[1:]))
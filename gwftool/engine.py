@@ -1,11 +1,21 @@
 
 import os
 import time
+import stat
 import json
-import shutil
+import uuid
+import Queue
+import hashlib
 import threading
 import subprocess
+import multiprocessing
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+from gwftool.history import ToolHistory, percentile
+from gwftool.hashing import FileHasher
+from gwftool.runlog import RunLog, epoch
+from gwftool.fileops import move_file, link_file
 
 
 def which(program):
@@ -35,15 +45,285 @@ def expand_galaxy_input_dict(val):
             o[kl[-1]] = v
     return out
 
+def file_size(inputs):
+    """
+    total size in bytes of the File records (and collections of them) found
+    in the top level of an input or output dict
+    """
+    total = 0
+    for v in inputs.values():
+        if not isinstance(v, list):
+            v = [v]
+        for e in v:
+            if isinstance(e, dict) and 'class' in e and e['class'] == 'File':
+                if os.path.exists(e['path']):
+                    total += os.path.getsize(e['path'])
+    return total
+
+
+def collection_elements(value):
+    """
+    The File records of a collection input: a list of File records, or a
+    Directory record whose files become the elements in name order. Returns
+    None for anything that isn't a collection
+    """
+    if isinstance(value, list):
+        return value
+    if isinstance(value, dict) and value.get('class', None) == 'Directory':
+        out = []
+        names = os.listdir(value['path'])
+        for name in sorted(names):
+            path = os.path.join(value['path'], name)
+            #<file>.json holds the metadata of <file>, it isn't an element
+            if name.endswith(".json") and name[:-5] in names:
+                continue
+            if os.path.isfile(path):
+                out.append({ "class" : "File", "path" : path })
+        return out
+    return None
+
+
+def element_step(key):
+    """
+    step id of a job key, the jobs of a mapped step are keyed 'step:element'
+    """
+    return str(key).split(":")[0]
+
+
+def free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def is_fifo(path):
+    return os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode)
+
+
+SIZE_SUFFIX = {'K' : 1024, 'M' : 1024**2, 'G' : 1024**3, 'T' : 1024**4}
+
+def watermark_bytes(spec, path):
+    """
+    convert a watermark spec ('500M', '20G', '5%', '1048576') into the
+    number of bytes that should be kept free on the filesystem of path
+    """
+    spec = str(spec).strip().upper()
+    if spec.endswith("%"):
+        st = os.statvfs(path)
+        return int(st.f_blocks * st.f_frsize * float(spec[:-1]) / 100.0)
+    if spec[-1] in SIZE_SUFFIX:
+        return int(float(spec[:-1]) * SIZE_SUFFIX[spec[-1]])
+    return int(spec)
+
+
+def file_paths(values):
+    """
+    paths of every File record in an input dict, at any depth
+    """
+    out = []
+    for v in values.values():
+        if isinstance(v, dict) and v.get('class', None) == 'File':
+            out.append(v['path'])
+        elif isinstance(v, dict):
+            out.extend(file_paths(v))
+    return out
+
+
+def placeholder_inputs(values, digests):
+    """
+    Copy of an input dict with every File path replaced by a placeholder
+    naming the file's content hash, digests maps paths to hashes
+    """
+    out = {}
+    for k, v in values.items():
+        if isinstance(v, dict) and v.get('class', None) == 'File':
+            out[k] = { "class" : "File", "path" : "__gwftool_input_%s__" % (digests[v['path']]) }
+        elif isinstance(v, dict):
+            out[k] = placeholder_inputs(v, digests)
+        else:
+            out[k] = v
+    return out
+
+
+def mount_dirs(paths):
+    """
+    The smallest set of directories whose mounts expose every path: the
+    parent of each path (and of its target, if it is a symlink), leaving
+    out any directory nested inside another in the set
+    """
+    parents = set()
+    for p in paths:
+        parents.add(os.path.dirname(p))
+        parents.add(os.path.dirname(os.path.realpath(p)))
+    out = []
+    for d in sorted(parents):
+        if not any(d == o or d.startswith(o.rstrip(os.sep) + os.sep) for o in out):
+            out.append(d)
+    return out
+
+
+def file_records(values):
+    for v in values.values():
+        if isinstance(v, dict) and 'class' in v and v['class'] == 'File':
+            yield v
+
+
+def job_seconds(job):
+    if job.starttime is None or job.endtime is None:
+        return None
+    return (job.endtime - job.starttime).total_seconds()
+
+
+def write_job_script(jobdir, script, name="script"):
+    script_path = os.path.join(jobdir, name)
+    with open(script_path, "w") as handle:
+        handle.write(script)
+    return script_path
+
+
+class JobPolicy(object):
+    """
+    Retry and timeout settings for a tool's jobs. A job that exits non-zero,
+    fails to start its container or runs past timeout seconds (its container
+    is killed) is retried up to retries times, waiting backoff * 2**attempt
+    seconds between attempts
+    """
+    def __init__(self, retries=0, backoff=5, timeout=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def retry_delay(self, attempt):
+        return self.backoff * (2 ** attempt)
+
+    @staticmethod
+    def from_dict(data, default=None):
+        if default is None:
+            default = JobPolicy()
+        return JobPolicy(
+            retries=data.get('retries', default.retries),
+            backoff=data.get('backoff', default.backoff),
+            timeout=data.get('timeout', default.timeout)
+        )
+
+
 class LocalManager:
-    def __init__(self, no_net=False):
+    """
+    Launches jobs as local docker containers. With pack=True, jobs are not
+    started as they are submitted but queued until flush() is called at the
+    end of a scheduling pass, then ready jobs that share an image are packed
+    into containers that run several of them in parallel. Pack sizes aim for
+    a container wall time of about pack_target seconds, based on the per job
+    runtimes recorded in history. Jobs follow the JobPolicy registered for
+    their tool in tool_policies, or the default policy
+    """
+    threaded = True
+
+    def __init__(self, no_net=False, pack=False, history=None, pack_target=60, max_pack=256, pack_parallel=None,
+        policy=None, tool_policies=None):
         self.no_net = no_net
+        self.pack = pack
+        if policy is None:
+            policy = JobPolicy()
+        self.policy = policy
+        if tool_policies is None:
+            tool_policies = {}
+        self.tool_policies = tool_policies
+        if history is None:
+            history = ToolHistory()
+        self.history = history
+        self.pack_target = pack_target
+        self.max_pack = max_pack
+        if pack_parallel is None:
+            pack_parallel = multiprocessing.cpu_count()
+        self.pack_parallel = pack_parallel
+        self.queued = []
     
+    def policy_for(self, tool):
+        return self.tool_policies.get(tool.tool_id, self.policy)
+
+    def group_policy(self, members):
+        """
+        Members of a group can't be retried on their own, so a group is never
+        retried. It times out once every member could have used its own timeout
+        """
+        timeout = 0
+        for m in members:
+            t = self.policy_for(m.tool).timeout
+            if t is None:
+                return JobPolicy()
+            timeout += t
+        return JobPolicy(timeout=timeout)
+
     def new_job(self, tool, jobid, jobdir, script, inputs, outputs):
-        return Runner(tool, jobid, jobdir, script, inputs, outputs, no_net=self.no_net)
+        if self.pack:
+            return GroupMember(tool, jobid, jobdir, script, inputs, outputs, manager=self)
+        return Runner(tool, jobid, jobdir, script, inputs, outputs, no_net=self.no_net, policy=self.policy_for(tool),
+            threaded=self.threaded)
+
+    def new_fused_job(self, jobs):
+        """
+        jobs is a list of new_job keyword dicts, in dependency order
+        """
+        members = list(GroupMember(**j) for j in jobs)
+        return GroupRunner(members, no_net=self.no_net, policy=self.group_policy(members), threaded=self.threaded)
+
+    def new_group(self, members):
+        return GroupRunner(members, no_net=self.no_net, parallel=True,
+            parallel_count=self.pack_parallel, policy=self.group_policy(members), threaded=self.threaded)
+
+    def submit(self, job):
+        self.queued.append(job)
+
+    def runtime_estimate(self, tool_id):
+        median = percentile(self.history.samples(tool_id, 'wall_seconds'), 50)
+        if median is None:
+            #nothing known yet, start with small packs and let them grow
+            return self.pack_target / 4.0
+        return max(median, 0.1)
+
+    def flush(self):
+        by_image = {}
+        for job in self.queued:
+            streamed = any(is_fifo(v['path']) for v in file_records(job.inputs)) or \
+                any(is_fifo(v['path']) for v in file_records(job.outputs))
+            if streamed:
+                #pipe ends must never wait on a slot in the same container
+                self.new_group([job]).start()
+            else:
+                by_image.setdefault(job.tool.get_docker_image(), []).append(job)
+        self.queued = []
+        for image, jobs in by_image.items():
+            pack = []
+            cost = 0.0
+            for job in jobs:
+                est = self.runtime_estimate(job.tool.tool_id)
+                if len(pack) and (len(pack) >= self.max_pack or (cost + est) / self.pack_parallel > self.pack_target):
+                    self.new_group(pack).start()
+                    pack = []
+                    cost = 0.0
+                pack.append(job)
+                cost += est
+            if len(pack):
+                self.new_group(pack).start()
+
+class PollingManager(LocalManager):
+    """
+    LocalManager whose jobs don't get a thread each: containers are launched,
+    timed out, retried and collected from the engine's scheduling loop
+    (see Runner threaded=False), so thousands of concurrent jobs cost
+    thousands of docker client processes but no extra threads
+    """
+    threaded = False
+
 
 class Runner(threading.Thread):
-    def __init__(self, tool, jobid, jobdir, script, inputs, outputs, no_net):
+    """
+    Runs a job in a docker container. By default the job runs in its own
+    thread. With threaded=False nothing runs in the background: start()
+    launches the container and every isAlive() call advances the job, so a
+    single scheduling loop drives all the jobs in flight
+    """
+    def __init__(self, tool, jobid, jobdir, script, inputs, outputs, no_net, policy=None, threaded=True):
         threading.Thread.__init__(self)
         self.tool = tool
         self.jobid = jobid
@@ -52,50 +332,309 @@ class Runner(threading.Thread):
         self.inputs = inputs
         self.outputs = outputs
         self.no_net = no_net
+        if policy is None:
+            policy = JobPolicy()
+        self.policy = policy
         self.stdout = None
         self.stderr = None
+        self.return_code = None
         self.starttime = None
         self.endtime = None
+        self.container = None
+        self.attempts = 0
+        self.timed_out = False
+        self.cancelled = False
+        self.threaded = threaded
+        self.proc = None
+        self.retry_at = None
+        self.done = False
+        #kill() holds the lock so no attempt can start after it, and sets killed to end a backoff early
+        self.lock = threading.Lock()
+        self.killed = threading.Event()
     
-    def run(self):
-        docker_image = self.tool.get_docker_image()
+    def get_mounts(self):
+        """
+        Inputs are mounted read only through their parent directories. Outputs
+        are written inside the job dir, except for named pipes which are
+        mounted on their own
+        """
         mounts = []
         print self.inputs
-        for k, v in self.inputs.items():
-            if isinstance(v, dict) and 'class' in v and v['class'] == 'File':
-                mounts.append("%s:%s:ro" % (v['path'], v['path']))
-        for k, v in self.outputs.items():
-            if isinstance(v, dict) and 'class' in v and v['class'] == 'File':
-                open(v['path'], "w").close()
+        for d in mount_dirs(list(v['path'] for v in file_records(self.inputs))):
+            mounts.append("%s:%s:ro" % (d, d))
+        for v in file_records(self.outputs):
+            if is_fifo(v['path']):
                 mounts.append("%s:%s" % (v['path'], v['path']))
-                
-        script_path = os.path.join(self.jobdir, "script")
-        with open(script_path, "w") as handle:
-            handle.write(self.script)
         mounts.append("%s:%s" % (self.jobdir, self.jobdir))
         mounts.append("%s:%s:ro" % (self.tool.tool_dir(), self.tool.tool_dir()))
-        cmd = [which("docker"), "run", "--rm"]
+        return mounts
+
+    def write_script(self):
+        return write_job_script(self.jobdir, self.script)
+
+    def docker_command(self, mounts, script_path):
+        cmd = [which("docker"), "run", "--rm", "--name", self.container]
         if self.no_net:
             cmd.append("--net=none")
         for i in mounts:
             cmd.extend(["-v", i])
         cmd.extend(["-u", str(os.getuid())])
         cmd.extend(["-w", self.jobdir])
-        cmd.append(docker_image)
+        cmd.append(self.tool.get_docker_image())
         cmd.append("bash")
         cmd.append(script_path)
-        print "running", " ".join(cmd)
-        self.starttime=datetime.now()
-        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        self.return_code = proc.returncode
-        self.stdout = stdout
-        self.stderr = stderr
+        return cmd
+
+    def run(self):
+        self.launch()
+        while not self.check():
+            self.killed.wait(0.5)
+
+    def launch(self):
+        """
+        Start an attempt. The docker client's output goes to files in the job
+        dir, so the job can be polled without blocking. Nothing is started once
+        the job has been killed
+        """
+        with self.lock:
+            if self.cancelled:
+                return
+            mounts = self.get_mounts()
+            script_path = self.write_script()
+            self.container = "gwftool_%s" % (uuid.uuid4().hex)
+            cmd = self.docker_command(mounts, script_path)
+            print "running", " ".join(cmd)
+            self.timed_out = False
+            self.retry_at = None
+            self.starttime=datetime.now()
+            with open(os.path.join(self.jobdir, "container_stdout"), "w") as stdout:
+                with open(os.path.join(self.jobdir, "container_stderr"), "w") as stderr:
+                    self.proc = subprocess.Popen(cmd, stderr=stderr, stdout=stdout)
+
+    def check(self):
+        """
+        Advance the job without blocking: enforce the timeout, collect a finished
+        attempt and start the next one once its backoff has passed. Returns True
+        once the job is done for good
+        """
+        if self.done:
+            return True
+        if self.proc is None:
+            if self.cancelled or self.retry_at is None:
+                return self.finish()
+            if time.time() >= self.retry_at:
+                self.launch()
+            return False
+        if self.proc.poll() is None:
+            timeout = self.policy.timeout
+            if timeout is not None and not self.timed_out and (datetime.now() - self.starttime).total_seconds() > timeout:
+                print "job %s passed its %s second timeout" % (self.jobid, timeout)
+                self.timed_out = True
+                self.kill_container()
+            return False
         self.endtime=datetime.now()
+        self.return_code = self.proc.returncode
+        self.proc = None
+        self.attempts += 1
+        with open(os.path.join(self.jobdir, "container_stdout")) as handle:
+            self.stdout = handle.read()
+        with open(os.path.join(self.jobdir, "container_stderr")) as handle:
+            self.stderr = handle.read()
+        if self.return_code == 0 or self.cancelled or self.attempts > self.policy.retries:
+            return self.finish()
+        delay = self.policy.retry_delay(self.attempts - 1)
+        print "job %s failed (exit %s%s), retrying in %s seconds" % (self.jobid, self.return_code,
+            ", timed out" if self.timed_out else "", delay)
+        self.retry_at = time.time() + delay
+        return False
+
+    def finish(self):
+        self.done = True
+        return True
+
+    def start(self):
+        if self.threaded:
+            threading.Thread.start(self)
+        else:
+            self.launch()
+
+    def isAlive(self):
+        if self.threaded:
+            return threading.Thread.isAlive(self)
+        return not self.check()
+
+    def join(self, timeout=None):
+        if self.threaded:
+            return threading.Thread.join(self, timeout)
+        while not self.check():
+            time.sleep(0.1)
+
+    def kill_container(self):
+        if self.container is not None:
+            subprocess.call([which("docker"), "kill", self.container], stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+
+    def kill(self):
+        """
+        Stop the job for good: kill its container and don't retry it
+        """
+        with self.lock:
+            self.cancelled = True
+            self.kill_container()
+        self.killed.set()
+
+
+GROUP_STEP = """cd %(jobdir)s
+echo start $(date +%%s.%%N) > %(jobdir)s/timing
+bash %(script)s > %(jobdir)s/stdout 2> %(jobdir)s/stderr
+echo $? > %(jobdir)s/exitcode
+echo end $(date +%%s.%%N) >> %(jobdir)s/timing
+if [ "$(cat %(jobdir)s/exitcode)" != "0" ]; then exit 1; fi
+"""
+
+GROUP_PARALLEL = """xargs -P %(count)d -n 1 bash <<EOF
+%(scripts)s
+EOF
+"""
+
+class GroupRunner(Runner):
+    """
+    Runs the scripts of several jobs that share a docker image in a single
+    container. By default (fused) jobs run in the order given, so a job may
+    read the outputs of the ones before it, and the group stops at the first
+    failure. With parallel=True (packed) the jobs are independent and run up
+    to parallel_count at a time. Each job records its own stdout, stderr, exit
+    code and timing in its job dir, which are collected into the GroupMember
+    objects once the container exits
+    """
+    def __init__(self, members, no_net, parallel=False, parallel_count=1, policy=None, threaded=True):
+        first = members[0]
+        Runner.__init__(self, first.tool, first.jobid, first.jobdir, None, {}, {}, no_net=no_net, policy=policy,
+            threaded=threaded)
+        self.members = members
+        self.parallel = parallel
+        self.parallel_count = parallel_count
+        for m in self.members:
+            m.group = self
+
+    def get_mounts(self):
+        produced = set()
+        for m in self.members:
+            for v in file_records(m.outputs):
+                produced.add(v['path'])
+        jobdirs = list(m.jobdir + os.sep for m in self.members)
+        inputs = []
+        mounts = []
+        for m in self.members:
+            for v in file_records(m.inputs):
+                #files written by earlier members are already visible through their own mounts
+                if v['path'] in produced or any(v['path'].startswith(d) for d in jobdirs):
+                    continue
+                inputs.append(v['path'])
+            for v in file_records(m.outputs):
+                if is_fifo(v['path']):
+                    mounts.append("%s:%s" % (v['path'], v['path']))
+            mounts.append("%s:%s" % (m.jobdir, m.jobdir))
+            mounts.append("%s:%s:ro" % (m.tool.tool_dir(), m.tool.tool_dir()))
+        out = list("%s:%s:ro" % (d, d) for d in mount_dirs(inputs))
+        for i in mounts:
+            if i not in out:
+                out.append(i)
+        return out
+
+    def write_script(self):
+        steps = []
+        for m in self.members:
+            steps.append(GROUP_STEP % {'jobdir' : m.jobdir, 'script' : m.write_script()})
+        if not self.parallel:
+            return write_job_script(self.jobdir, "\n".join(steps), name="group_script")
+        scripts = []
+        for m, step in zip(self.members, steps):
+            scripts.append(write_job_script(m.jobdir, step, name="member_script"))
+        group_script = GROUP_PARALLEL % {'count' : self.parallel_count, 'scripts' : "\n".join(scripts)}
+        return write_job_script(self.jobdir, group_script, name="group_script")
+
+    def finish(self):
+        for m in self.members:
+            m.collect()
+        return Runner.finish(self)
+
+
+class GroupMember(object):
+    """
+    A job run inside a GroupRunner, presenting the same attributes as a Runner.
+    Jobs created by a packing manager are queued on start() and only get
+    their group when the manager flushes its queue
+    """
+    def __init__(self, tool, jobid, jobdir, script, inputs, outputs, manager=None):
+        self.group = None
+        self.manager = manager
+        self.tool = tool
+        self.jobid = jobid
+        self.jobdir = jobdir
+        self.script = script
+        self.inputs = inputs
+        self.outputs = outputs
+        self.stdout = None
+        self.stderr = None
+        self.return_code = None
+        self.starttime = None
+        self.endtime = None
+        self.attempts = 1
+        self.cancelled = False
+
+    def write_script(self):
+        return write_job_script(self.jobdir, self.script)
+
+    def start(self):
+        self.manager.submit(self)
+
+    def isAlive(self):
+        if self.group is None:
+            return not self.cancelled
+        return self.group.isAlive()
+
+    def kill(self):
+        """
+        Jobs still queued are dropped, otherwise the whole group is stopped
+        """
+        self.cancelled = True
+        if self.group is None:
+            if self in self.manager.queued:
+                self.manager.queued.remove(self)
+        else:
+            self.group.kill()
+
+    def collect(self):
+        for name in ['stdout', 'stderr']:
+            path = os.path.join(self.jobdir, name)
+            if os.path.exists(path):
+                with open(path) as handle:
+                    setattr(self, name, handle.read())
+        path = os.path.join(self.jobdir, "exitcode")
+        if os.path.exists(path):
+            with open(path) as handle:
+                self.return_code = int(handle.read().strip())
+        timing = {}
+        path = os.path.join(self.jobdir, "timing")
+        if os.path.exists(path):
+            with open(path) as handle:
+                for line in handle:
+                    tmp = line.split()
+                    if len(tmp) == 2:
+                        try:
+                            timing[tmp[0]] = datetime.fromtimestamp(float(tmp[1]))
+                        except ValueError:
+                            pass
+        #members that never ran (or an image without GNU date) fall back to the group times
+        self.starttime = timing.get("start", self.group.starttime)
+        self.endtime = timing.get("end", self.group.endtime)
+
 
 class WorkflowState:
     
-    def __init__(self, outdir, workdir, inputs, workflow):
+    def __init__(self, outdir, workdir, inputs, workflow, history=None, stream_tools=None, speculate=None,
+        harvest_workers=4, harvest_pool=None, wakeup=None, overrides=None, leases=None, hasher=None,
+        runlog=None, name=None):
         self.inputs = inputs
         self.workflow = workflow
         self.results = {}
@@ -106,13 +645,63 @@ class WorkflowState:
         self.job_num = 0
         
         self.running = {}
+        if history is None:
+            history = ToolHistory()
+        self.history = history
+        self.reserved = {}
+        self.deferred = set()
+        if stream_tools is None:
+            stream_tools = []
+        self.stream_tools = set(stream_tools)
+        self.streaming = {}
+        self.fifos = set()
+        self.speculate_factor = speculate
+        self.speculative = {}
+        self.failed = {}
+        self.skipped = {}
+        self.stopped = False
+        self.destinations = {}
+        self.mapping = {}
+        self.aliases = {}
+        self.leases = leases
+        if hasher is None:
+            hasher = FileHasher()
+        self.hasher = hasher
+        self.runlog = runlog
+        self.name = name
+        self.leased = {}
+        self.holding = {}
+        self.harvesting = {}
+        self.committed = Queue.Queue()
+        #the pool may be shared with the other input sets of a batch
+        self.own_pool = harvest_pool is None
+        if harvest_pool is None:
+            harvest_pool = ThreadPool(harvest_workers)
+        self.harvest_pool = harvest_pool
+        if wakeup is None:
+            wakeup = threading.Event()
+        self.wakeup = wakeup
         
         for step in workflow.steps():
             if step.type == 'data_input':
                 i = inputs[step.label]
+                elements = collection_elements(i)
+                if elements is not None:
+                    i = elements
                 self.results[ str(step.step_id) ] = { "output" : i }
             else:
                 self.states[ str(step.step_id) ] = step.tool_state
+        #parameter overrides (of a sweep) are applied by step label
+        if overrides is None:
+            overrides = {}
+        for label, params in overrides.items():
+            found = False
+            for step in workflow.tool_steps():
+                if step.label == label:
+                    self.states[ str(step.step_id) ].update(params)
+                    found = True
+            if not found:
+                raise Exception("Step %s not found" % (label))
                 
     def missing_inputs(self, step):
         out = []
@@ -127,28 +716,141 @@ class WorkflowState:
             if i['name'] not in self.inputs:
                 ready = False
         for name, conn in step.input_connections.items():
-            if str(conn['id']) not in self.results:
+            if not self.connection_available(conn):
                 ready = False
         return ready
+
+    def connection_available(self, conn):
+        conn_id = str(conn['id'])
+        if conn['output_name'] in self.results.get(conn_id, {}):
+            return True
+        return conn['output_name'] in self.streaming.get(conn_id, [])
+
+    def consumers(self, step_id, output_name):
+        out = []
+        for step in self.workflow.tool_steps():
+            for name, conn in step.input_connections.items():
+                if str(conn['id']) == str(step_id) and conn['output_name'] == output_name:
+                    out.append(step)
+        return out
+
+    def consumes_stream(self, step):
+        for name, conn in step.input_connections.items():
+            if conn['output_name'] in self.streaming.get(str(conn['id']), []):
+                return True
+        return False
+
+    def can_stream(self, step_id, output_name, tool_output):
+        """
+        An output is written to a named pipe, rather than a file, if it has exactly
+        one consumer, that consumer's tool reads its inputs sequentially (listed in
+        stream_tools) and every other input of the consumer is already available, so
+        it can be launched alongside the producer. Everything else falls back to files
+        """
+        if len(self.stream_tools) == 0 or tool_output.from_work_dir is not None:
+            return False
+        consumers = self.consumers(step_id, output_name)
+        if len(consumers) != 1:
+            return False
+        consumer = consumers[0]
+        if consumer.tool_id not in self.stream_tools or self.is_mapped(step_id):
+            return False
+        if self.step_running(consumer) or self.step_done(consumer):
+            return False
+        for name, conn in consumer.input_connections.items():
+            if str(conn['id']) != str(step_id) and conn['output_name'] not in self.results.get(str(conn['id']), {}):
+                return False
+        return not self.is_mapped(consumer.step_id)
     
     def step_running(self, step):
-        return str(step.step_id) in self.running
+        sid = str(step.step_id)
+        return sid in self.running or sid in self.harvesting or sid in self.mapping or sid in self.aliases or \
+            sid in self.leased
     
     def step_done(self, step):
-        return str(step.step_id) in self.results
+        return str(step.step_id) in self.results and str(step.step_id) not in self.harvesting
+
+    def step_blocked(self, step):
+        return str(step.step_id) in self.failed or str(step.step_id) in self.skipped
     
-    def generate_outputs(self, step_id, tool):
+    def fusion_chain(self, step, tool, toolbox):
+        """
+        Starting at a ready step, follow single consumer links to steps that use
+        the same docker image and whose other inputs are already available.
+        Returns the list of (step, tool) pairs that can run in one container
+        """
+        chain = [(step, tool)]
+        members = set([str(step.step_id)])
+        image = tool.get_docker_image()
+        cur, cur_tool = step, tool
+        while True:
+            consumers = {}
+            for name in cur_tool.get_outputs():
+                for c in self.consumers(cur.step_id, name):
+                    consumers[str(c.step_id)] = c
+            if len(consumers) != 1:
+                break
+            nxt = consumers.values()[0]
+            if nxt.tool_id not in toolbox or self.step_running(nxt) or self.step_done(nxt):
+                break
+            nxt_tool = toolbox[nxt.tool_id]
+            if nxt_tool.get_docker_image() != image or len(self.missing_inputs(nxt)) or \
+                self.is_mapped(nxt.step_id):
+                break
+            ready = True
+            for name, conn in nxt.input_connections.items():
+                if str(conn['id']) not in members and conn['output_name'] not in self.results.get(str(conn['id']), {}):
+                    ready = False
+            if not ready:
+                break
+            chain.append((nxt, nxt_tool))
+            members.add(str(nxt.step_id))
+            cur, cur_tool = nxt, nxt_tool
+        return chain
+
+    def generate_outputs(self, step_id, tool, stream=True):
         outputs = tool.get_outputs()
         out = {}
-        outdir = os.path.join(self.outdir, str(step_id))
+        #the element jobs of a mapped step write to <outdir>/<step>/<element>
+        subdir = os.path.join(*str(step_id).split(":"))
+        outdir = os.path.join(self.outdir, subdir)
         if not os.path.exists(outdir):
-            os.mkdir(outdir)
+            os.makedirs(outdir)
         for name, data in tool.get_outputs().items():
-            path = os.path.join("./", str(step_id), name)
+            path = os.path.join("./", subdir, name)
             out[name] = { "class" : "File", "path" : os.path.abspath(os.path.join(self.outdir, path)) }
+            if stream and self.can_stream(step_id, name, data):
+                if os.path.exists(out[name]['path']):
+                    os.unlink(out[name]['path'])
+                os.mkfifo(out[name]['path'])
+                self.fifos.add(out[name]['path'])
+                self.streaming.setdefault(str(step_id), set()).add(name)
+                print "streaming %s:%s through %s" % (step_id, name, out[name]['path'])
+        self.destinations[str(step_id)] = out
+        return out
+
+    def stage_outputs(self, job_dir, outputs):
+        """
+        Jobs write their outputs into the job dir, they are only published to
+        the outdir once the job has succeeded (see harvest). Named pipes are
+        left where they are
+        """
+        staging = os.path.join(job_dir, "outputs")
+        os.mkdir(staging)
+        out = {}
+        for name, v in outputs.items():
+            if v['path'] in self.fifos:
+                out[name] = v
+            else:
+                out[name] = { "class" : "File", "path" : os.path.join(staging, name) }
         return out
     
-    def step_inputs(self, step_id):
+    def step_inputs(self, step_id, planned=None, element=None):
+        """
+        Build the input dict for a step. planned maps step ids of jobs fused into
+        the same container to where their outputs will be found inside it. For
+        the jobs of a mapped step, element picks the entry of each collection
+        """
         step_id = str(step_id)
         out = {}
         for k,v in self.states[step_id].items():
@@ -159,15 +861,58 @@ class WorkflowState:
             conn_id = str(conn['id'])
             if self.workflow.get_step(conn_id).type == 'data_input':
                 out[name] = self.results[conn_id]['output']
-            else:
+            elif conn['output_name'] in self.results.get(conn_id, {}):
                 out[name] = self.results[conn_id][conn['output_name']]
+            elif planned is not None and conn_id in planned:
+                out[name] = planned[conn_id][conn['output_name']]
+            else:
+                out[name] = self.running[conn_id].outputs[conn['output_name']]
+            if element is not None and isinstance(out[name], list):
+                out[name] = out[name][element]
         out = expand_galaxy_input_dict(out)
         return out
     
-    def add_outputs(self, step_id, outputs):
-        step_id = str(step_id)
-        self.results[step_id] = outputs
-    
+    def reserve_disk(self, step, tool, watermark):
+        """
+        Admission control: estimate the bytes the step will write from the
+        tool's history and check that the outdir and workdir filesystems keep
+        at least `watermark` free once it, and every running job, is done.
+        Returns True (and reserves the estimate) if the step may be launched
+        """
+        if watermark is None or self.consumes_stream(step):
+            #a stream consumer has to run alongside its producer, so it is never deferred
+            return True
+        step_id = str(step.step_id)
+        estimate = self.history.estimate_output(tool.tool_id, file_size(self.step_inputs(step_id)))
+        reserved = self.outstanding_reservations()
+        for path in set([self.outdir, self.workdir]):
+            if free_space(path) - reserved - estimate < watermark_bytes(watermark, path):
+                if step_id not in self.deferred:
+                    print "Deferring step %s: estimated %d bytes would pass the disk watermark on %s" % (step_id, estimate, path)
+                    self.deferred.add(step_id)
+                return False
+        self.deferred.discard(step_id)
+        self.reserved[step_id] = estimate
+        return True
+
+    def outstanding_reservations(self):
+        """
+        Bytes reserved for launched steps that they have not written yet. What
+        they already wrote is no longer in the free space statvfs reports, so
+        it is not counted against it a second time
+        """
+        total = 0
+        for step_id, estimate in self.reserved.items():
+            written = 0
+            for k, v in self.running.items():
+                if element_step(k) == step_id:
+                    written += file_size(v.outputs)
+            for k, v in self.results.items():
+                if k != step_id and element_step(k) == step_id:
+                    written += file_size(v)
+            total += max(estimate - written, 0)
+        return total
+
     def create_jobdir(self, step_id):
         self.job_num += 1
         j = os.path.abspath(os.path.join(self.workdir, "jobs", str(self.job_num)))
@@ -176,8 +921,8 @@ class WorkflowState:
     
     def run_job(self, step, tool, manager):
         sinputs = self.step_inputs(step.step_id)
-        outputs = self.generate_outputs(step.step_id, tool)
         job_dir = self.create_jobdir(step.step_id)
+        outputs = self.stage_outputs(job_dir, self.generate_outputs(step.step_id, tool))
         script = tool.render_cmdline(sinputs, outputs)
         print "script (in %s): %s" % (job_dir, script)
         #print "step_inputs", sinputs
@@ -185,52 +930,535 @@ class WorkflowState:
         r.start()
         self.running[str(step.step_id)] = r
     
+    def job_key(self, step, tool):
+        """
+        Identifies a job by what it runs: the tool, its image, the command
+        rendered with placeholder outputs and the inputs. Jobs with the same
+        key produce the same outputs. None for jobs reading a named pipe
+        """
+        sinputs = self.step_inputs(step.step_id)
+        if any(is_fifo(v['path']) for v in file_records(sinputs)):
+            return None
+        outputs = {}
+        for name in tool.get_outputs():
+            outputs[name] = { "class" : "File", "path" : "__gwftool_output_%s__" % (name) }
+        script = tool.render_cmdline(sinputs, outputs)
+        return json.dumps([tool.tool_id, tool.get_docker_image(), script, sinputs], sort_keys=True)
+
+    def alias(self, step_id, tool, owner, owner_step):
+        """
+        Take the outputs of a step of owner (possibly another input set of the
+        same batch) running an identical job, rather than running it again.
+        They are linked into the step's own outdir once the owner has published them
+        """
+        print "step %s is the same job as step %s of %s" % (step_id, owner_step, owner.outdir)
+        self.aliases[str(step_id)] = (tool, owner, owner_step)
+
+    def resolve_aliases(self):
+        for k, (tool, owner, owner_step) in self.aliases.items():
+            if owner_step in owner.failed or owner_step in owner.skipped:
+                del self.aliases[k]
+                self.fail_step(k, "shared job, step %s of %s, did not succeed" % (owner_step, owner.outdir))
+            elif owner_step in owner.results and owner_step not in owner.harvesting:
+                del self.aliases[k]
+                self.link_outputs(k, tool, owner.results[owner_step])
+
+    def lease_key(self, step, tool):
+        """
+        Like job_key, but the same in any run on the host: input paths are
+        replaced by their content hashes
+        """
+        sinputs = self.step_inputs(step.step_id)
+        digests = self.hasher.digest_many(file_paths(sinputs))
+        sinputs = placeholder_inputs(sinputs, digests)
+        outputs = {}
+        for name in tool.get_outputs():
+            outputs[name] = { "class" : "File", "path" : "__gwftool_output_%s__" % (name) }
+        script = tool.render_cmdline(sinputs, outputs)
+        key = json.dumps([tool.tool_id, tool.get_docker_image(), script, sorted(digests.values())], sort_keys=True)
+        return hashlib.sha1(key).hexdigest()
+
+    def wait_lease(self, step_id, key, tool):
+        print "step %s is being run by another gwftool process (lease %s), waiting for it" % (step_id, key)
+        self.leased[str(step_id)] = (key, tool)
+
+    def reuse_lease(self, step_id, tool, outputs):
+        """
+        Link the outputs another process published for an identical job into
+        this run's outdir
+        """
+        print "step %s reuses the outputs of an identical job run by another gwftool process" % (step_id)
+        self.link_outputs(step_id, tool, outputs)
+
+    def link_outputs(self, step_id, tool, outputs):
+        """
+        Publish the outputs of an identical job as the step's own, by linking
+        them into its destinations on the harvest pool. Each one is released to
+        consumers once committed (see collect_harvest)
+        """
+        step_id = str(step_id)
+        destinations = self.generate_outputs(step_id, tool, stream=False)
+        self.results[step_id] = {}
+        self.harvesting[step_id] = (None, set(outputs), False)
+        for name, v in outputs.items():
+            self.harvest_pool.apply_async(self.commit_output,
+                (step_id, name, v['path'], destinations[name]['path'], link_file))
+
+    def resolve_leases(self):
+        for k, (key, tool) in self.leased.items():
+            outputs = self.leases.result(key)
+            if outputs is not None:
+                del self.leased[k]
+                self.reuse_lease(k, tool, outputs)
+            elif self.leases.stale(key):
+                #the other process failed or died, the step is scheduled again
+                del self.leased[k]
+        for k, key in self.holding.items():
+            self.leases.heartbeat(key)
+
+    def drop_lease(self, step_id):
+        if step_id in self.holding:
+            self.leases.release(self.holding.pop(step_id))
+
+    def collection_widths(self, step_id):
+        widths = set()
+        for name, conn in self.workflow.get_step(str(step_id)).input_connections.items():
+            value = self.results.get(str(conn['id']), {}).get(conn['output_name'], None)
+            if isinstance(value, list):
+                widths.add(len(value))
+        return widths
+
+    def is_mapped(self, step_id):
+        return len(self.collection_widths(step_id)) > 0
+
+    def map_width(self, step_id):
+        """
+        Number of jobs a step is mapped over: the length of the collections
+        connected to it, or None if it takes no collection. Raises ValueError
+        if their lengths don't match
+        """
+        widths = self.collection_widths(step_id)
+        if len(widths) > 1:
+            raise ValueError("mapped over collections of different lengths: %s" % (sorted(widths)))
+        if len(widths) == 0:
+            return None
+        return widths.pop()
+
+    def run_mapped(self, step, tool, manager, width, limit=None):
+        """
+        Launch one job per collection element, keyed 'step:element'. Their
+        outputs are gathered into collections once all of them are published.
+        At most limit jobs are launched now, the rest by launch_elements as
+        slots free up
+        """
+        step_id = str(step.step_id)
+        print "mapping step %s over %d elements" % (step_id, width)
+        self.mapping[step_id] = { "width" : width, "tool" : tool, "launched" : 0 }
+        if width == 0:
+            self.gather(step_id)
+            return 0
+        return self.launch_elements(step_id, manager, limit)
+
+    def pending_elements(self):
+        return list(k for k, v in self.mapping.items() if v['launched'] < v['width'])
+
+    def launch_elements(self, step_id, manager, limit=None):
+        m = self.mapping[step_id]
+        count = m['width'] - m['launched']
+        if limit is not None:
+            count = min(count, limit)
+        tool = m['tool']
+        for i in range(m['launched'], m['launched'] + count):
+            key = "%s:%d" % (step_id, i)
+            sinputs = self.step_inputs(step_id, element=i)
+            job_dir = self.create_jobdir(key)
+            outputs = self.stage_outputs(job_dir, self.generate_outputs(key, tool, stream=False))
+            script = tool.render_cmdline(sinputs, outputs)
+            print "script (in %s): %s" % (job_dir, script)
+            r = manager.new_job(tool=tool, jobid=key, jobdir=job_dir, script=script, inputs=sinputs, outputs=outputs)
+            r.start()
+            self.running[key] = r
+        m['launched'] += count
+        return count
+
+    def gather(self, step_id):
+        """
+        Once every element job of a mapped step is published, turn their
+        outputs into the step's output collections
+        """
+        m = self.mapping[step_id]
+        keys = list("%s:%d" % (step_id, i) for i in range(m['width']))
+        if any(k not in self.results or k in self.harvesting for k in keys):
+            return
+        self.results[step_id] = {}
+        for name in m['tool'].get_outputs():
+            self.results[step_id][name] = list(self.results[k][name] for k in keys)
+        for k in keys:
+            del self.results[k]
+        del self.mapping[step_id]
+        self.reserved.pop(step_id, None)
+
+    def run_fused(self, chain, manager):
+        planned = {}
+        jobs = []
+        for step, tool in chain:
+            sinputs = self.step_inputs(step.step_id, planned)
+            job_dir = self.create_jobdir(step.step_id)
+            #only the last member's outputs leave the container while it is running
+            outputs = self.stage_outputs(job_dir, self.generate_outputs(step.step_id, tool, stream=(step is chain[-1][0])))
+            script = tool.render_cmdline(sinputs, outputs)
+            print "script (in %s): %s" % (job_dir, script)
+            #outputs are only published after the container exits,
+            #so later members read them straight from the producer's job dir
+            located = {}
+            for name, data in tool.get_outputs().items():
+                if data.from_work_dir is not None:
+                    located[name] = { "class" : "File", "path" : os.path.abspath(os.path.join(job_dir, data.from_work_dir)) }
+                else:
+                    located[name] = outputs[name]
+            planned[str(step.step_id)] = located
+            jobs.append(dict(tool=tool, jobid=step.step_id, jobdir=job_dir, script=script, inputs=sinputs, outputs=outputs))
+        print "fusing steps %s" % (",".join(str(step.step_id) for step, tool in chain))
+        group = manager.new_fused_job(jobs)
+        group.start()
+        for m in group.members:
+            self.running[str(m.jobid)] = m
+
+    def log(self, event, **record):
+        if self.runlog is not None:
+            record['event'] = event
+            record['set'] = self.name
+            self.runlog.write(record)
+
     def add_jobreport(self, job):
-        meta_path = os.path.join(self.outdir, str(job.jobid) + ".json")
-        with open(meta_path, "w") as handle:
-            meta = {
-                "stderr" : job.stderr,
-                "stdout" : job.stdout,
-                "script" : job.script,
-                "image"  : job.tool.get_docker_image(),
-                "tool"   : job.tool.tool_id,
-                "exitcode" : job.return_code,
-                "wallSeconds" : (job.endtime - job.starttime).total_seconds()
-            }
-            handle.write(json.dumps(meta))
-        
+        self.log("job",
+            step=element_step(job.jobid),
+            job=str(job.jobid),
+            jobdir=job.jobdir,
+            stderr=job.stderr,
+            stdout=job.stdout,
+            script=job.script,
+            image=job.tool.get_docker_image(),
+            tool=job.tool.tool_id,
+            exitcode=job.return_code,
+            attempts=job.attempts,
+            start=epoch(job.starttime),
+            end=epoch(job.endtime),
+            wallSeconds=job_seconds(job)
+        )
     
+    def release_streams(self, job, producer, failed=False):
+        """
+        Once a producer exits, give any consumer still blocked opening the pipe its
+        EOF (a failed producer may never have opened it). Once a consumer exits,
+        a producer still blocked opening the pipe for writing is let through (its
+        writes then fail), a failed consumer's producer is killed and failed, and
+        the pipes it read from are removed from the outdir
+        """
+        if producer:
+            for name in self.streaming.pop(str(job.jobid)):
+                if is_fifo(job.outputs[name]['path']):
+                    fd = os.open(job.outputs[name]['path'], os.O_RDWR | os.O_NONBLOCK)
+                    os.close(fd)
+        for k, v in job.inputs.items():
+            if isinstance(v, dict) and 'class' in v and v['class'] == 'File' and v['path'] in self.fifos:
+                fd = os.open(v['path'], os.O_RDONLY | os.O_NONBLOCK)
+                os.close(fd)
+                if failed:
+                    for pk, p in self.running.items():
+                        if any(o['path'] == v['path'] for o in p.outputs.values()):
+                            p.kill()
+                            if element_step(pk) not in self.failed:
+                                self.fail_step(pk, "consumer %s of its streamed output failed" % (job.jobid))
+                os.unlink(v['path'])
+                self.fifos.discard(v['path'])
+
+    def speculate(self, manager):
+        """
+        Launch a duplicate of any job that has been running far (speculate_factor
+        times) past the 95th percentile of its tool's recorded wall times. The
+        duplicate stages its outputs in its own job dir, and whichever of the two
+        finishes first is published
+        """
+        if self.speculate_factor is None:
+            return
+        for k, v in self.running.items():
+            if k in self.speculative or not isinstance(v, Runner) or v.starttime is None or v.cancelled:
+                continue
+            if any(is_fifo(i['path']) for i in file_records(v.inputs)) or k in self.streaming:
+                continue
+            walls = self.history.samples(v.tool.tool_id, 'wall_seconds')
+            if len(walls) < 5:
+                continue
+            limit = percentile(walls, 95) * self.speculate_factor
+            if (datetime.now() - v.starttime).total_seconds() < limit:
+                continue
+            job_dir = self.create_jobdir(k)
+            outputs = self.stage_outputs(job_dir, self.destinations[k])
+            script = v.tool.render_cmdline(v.inputs, outputs)
+            print "job %s has run over %.1f seconds, launching a speculative copy in %s" % (k, limit, job_dir)
+            dup = manager.new_job(tool=v.tool, jobid=v.jobid, jobdir=job_dir, script=script, inputs=v.inputs, outputs=outputs)
+            dup.start()
+            self.speculative[k] = dup
+
+    def resolve_speculative(self):
+        for k, dup in self.speculative.items():
+            orig = self.running.get(k, None)
+            if orig is None or not orig.isAlive():
+                #the original (already harvested, or finished) is kept whatever its outcome
+                dup.kill()
+            elif not dup.isAlive():
+                if dup.return_code == 0:
+                    print "speculative copy of job %s finished first" % (k)
+                    orig.kill()
+                    orig.join()
+                    self.running[k] = dup
+            else:
+                continue
+            del self.speculative[k]
+
+    def job_failure(self, job, streamed):
+        """
+        Returns why a finished job failed, or None if it succeeded. Outputs passed
+        through a named pipe are not expected to exist once the job is done
+        """
+        if job.cancelled:
+            return "cancelled"
+        if job.return_code is None:
+            return "not run"
+        if job.return_code != 0:
+            return "exit code %s" % (job.return_code)
+        for name, data in job.tool.get_outputs().items():
+            if name not in streamed and not os.path.exists(self.output_source(job, name, data)):
+                return "missing output %s" % (name)
+        return None
+
+    def output_source(self, job, name, data):
+        """
+        Where a finished job left an output: the from_work_dir file, otherwise
+        its staged path
+        """
+        if data.from_work_dir is not None:
+            return os.path.abspath(os.path.join(job.jobdir, data.from_work_dir))
+        return job.outputs[name]['path']
+
+    def fail_step(self, step_id, reason):
+        """
+        Record a failed step and mark every step downstream of it as skipped.
+        A failed element job fails its whole mapped step
+        """
+        if ":" in str(step_id):
+            reason = "element %s: %s" % (str(step_id).split(":")[1], reason)
+            step_id = element_step(step_id)
+            for k in self.results.keys():
+                if element_step(k) == step_id and k != step_id:
+                    del self.results[k]
+            for k in self.harvesting.keys():
+                if element_step(k) == step_id:
+                    del self.harvesting[k]
+            self.mapping.pop(step_id, None)
+            self.reserved.pop(step_id, None)
+            if step_id in self.failed:
+                return
+        print "Error: step %s failed: %s" % (step_id, reason)
+        self.log("step_failed", step=step_id, reason=reason)
+        self.drop_lease(step_id)
+        self.failed[step_id] = reason
+        stack = [step_id]
+        while len(stack):
+            cur = stack.pop()
+            for step in self.workflow.tool_steps():
+                sid = str(step.step_id)
+                #a fused member harvested before its producer was never run because of it
+                blocked = sid in self.skipped or sid in self.results or \
+                    (sid in self.failed and self.failed[sid] != "not run")
+                for name, conn in step.input_connections.items():
+                    if str(conn['id']) == cur and not blocked:
+                        self.failed.pop(sid, None)
+                        self.skipped[sid] = step_id
+                        self.deferred.discard(sid)
+                        stack.append(sid)
+
+    def cancel(self):
+        """
+        Stop the run: kill every job in flight and don't start any more
+        """
+        self.stopped = True
+        self.deferred.clear()
+        self.mapping.clear()
+        self.aliases.clear()
+        self.leased.clear()
+        for k, v in self.running.items():
+            print "Cancelling job %s" % (k)
+            v.kill()
+        for k, dup in self.speculative.items():
+            dup.kill()
+        self.speculative.clear()
+        for step in self.workflow.tool_steps():
+            sid = str(step.step_id)
+            if sid not in self.results and sid not in self.failed and sid not in self.skipped and \
+                not self.step_running(step):
+                self.skipped[sid] = None
+
+    def summary(self):
+        """
+        Print the outcome of every step, returns True if all of them succeeded
+        """
+        ok = True
+        for step in self.workflow.tool_steps():
+            sid = str(step.step_id)
+            if sid in self.failed:
+                print "step %s (%s): failed, %s" % (sid, step.tool_id, self.failed[sid])
+            elif sid in self.skipped and self.skipped[sid] is None:
+                print "step %s (%s): skipped, run cancelled" % (sid, step.tool_id)
+            elif sid in self.skipped:
+                print "step %s (%s): skipped, upstream step %s failed" % (sid, step.tool_id, self.skipped[sid])
+            elif sid not in self.results:
+                print "step %s (%s): not run, missing %s" % (sid, step.tool_id,
+                    ",".join(str(conn['id']) for conn in step.input_connections.values() if not self.connection_available(conn)))
+            else:
+                continue
+            ok = False
+        done = len(list(step for step in self.workflow.tool_steps() if self.step_done(step)))
+        print "Workflow %s: %d steps done, %d failed, %d skipped" % ("succeeded" if ok else "failed",
+            done, len(self.failed), len(self.skipped))
+        self.log("summary", ok=ok, done=done, failed=self.failed, skipped=self.skipped)
+        return ok
+
+    def harvest(self, k, job):
+        """
+        Check a finished job and start publishing its outputs. Each one is moved
+        from the job dir into the outdir on the harvest pool, and released to its
+        consumers as soon as it has been committed (see collect_harvest). Named
+        pipes are registered at once
+        """
+        self.harvest_pool.apply_async(self.add_jobreport, (job,))
+        streamed = self.streaming.get(k, [])
+        failure = self.job_failure(job, streamed)
+        step_id = element_step(k)
+        if step_id not in self.mapping:
+            self.reserved.pop(k, None)
+        if step_id in self.skipped:
+            print "Discarding outputs of step %s, upstream step %s failed" % (k, self.skipped[step_id])
+            self.drop_lease(k)
+        elif step_id in self.failed:
+            print "Discarding outputs of step %s, step failed" % (k)
+            self.drop_lease(k)
+        elif failure is not None:
+            self.fail_step(k, failure)
+        else:
+            self.results[k] = {}
+            pending = set()
+            destinations = self.destinations[k]
+            for name, data in job.tool.get_outputs().items():
+                src = self.output_source(job, name, data)
+                if src == destinations[name]['path']:
+                    self.results[k][name] = destinations[name]
+                else:
+                    pending.add(name)
+                    self.harvest_pool.apply_async(self.commit_output, (k, name, src, destinations[name]['path']))
+            #sizes of streamed outputs say nothing about what the tool writes
+            record = len(streamed) == 0
+            if len(pending):
+                self.harvesting[k] = (job, pending, record)
+            else:
+                self.harvest_done(k, job, record)
+        self.release_streams(job, k in self.streaming, failure is not None)
+
+    def commit_output(self, k, name, src, dst, op=move_file):
+        """
+        Runs on the harvest pool, the outcome is passed back to the scheduling
+        thread through the committed queue
+        """
+        try:
+            print "%s %s %s" % ("mv" if op is move_file else "ln", src, dst)
+            op(src, dst)
+            self.committed.put((k, name, None))
+        except (IOError, OSError) as e:
+            self.committed.put((k, name, str(e)))
+        self.wakeup.set()
+
+    def collect_harvest(self):
+        """
+        Register the outputs committed since the last call
+        """
+        while True:
+            try:
+                k, name, error = self.committed.get_nowait()
+            except Queue.Empty:
+                break
+            if k not in self.harvesting:
+                continue
+            job, pending, record = self.harvesting[k]
+            if error is not None:
+                del self.harvesting[k]
+                del self.results[k]
+                self.fail_step(k, "could not commit output %s: %s" % (name, error))
+                continue
+            self.results[k][name] = self.destinations[k][name]
+            pending.discard(name)
+            if len(pending) == 0:
+                del self.harvesting[k]
+                self.harvest_done(k, job, record)
+
+    def harvest_done(self, k, job, record):
+        if record:
+            self.history.add(job.tool.tool_id,
+                input_bytes=file_size(job.inputs),
+                output_bytes=file_size(self.destinations[k]),
+                wall_seconds=job_seconds(job)
+            )
+        if element_step(k) in self.mapping:
+            self.gather(element_step(k))
+        if k in self.holding:
+            self.leases.publish(self.holding.pop(k), self.results[k])
+
     def has_running(self):
-        running = len(self.running) > 0
+        running = len(self.running) > 0 or len(self.harvesting) > 0 or len(self.pending_elements()) > 0 or \
+            len(self.aliases) > 0 or len(self.leased) > 0
         #print "Running", len(self.running)
-        cleanup = []
+        self.resolve_speculative()
+        self.resolve_aliases()
+        if self.leases is not None:
+            self.resolve_leases()
+        self.collect_harvest()
         for k, v in self.running.items():
             if not v.isAlive():
-                cleanup.append(k)
-                t_outputs = v.tool.get_outputs()
-                for o, d in t_outputs.items():
-                    if d.from_work_dir is not None:
-                        src = os.path.abspath(os.path.join(v.jobdir, d.from_work_dir))
-                        dst = v.outputs[o]['path'] 
-                        print "mv %s %s" % (src, dst)
-                        if os.path.exists(src):
-                            shutil.move(src, dst)
-                        else:
-                            print "Error: Missing output %s %s" % (k, src)
-                self.add_jobreport(v)
-                self.add_outputs(k, v.outputs)
-        for i in cleanup:
-            del self.running[i]
+                del self.running[k]
+                self.harvest(k, v)
         return running
 
+    def close(self):
+        if self.own_pool:
+            self.harvest_pool.close()
+            self.harvest_pool.join()
+
 
 
 class Engine:
-    def __init__(self, outdir, workdir, toolbox, manager=None):
+    def __init__(self, outdir, workdir, toolbox, manager=None, history=None, disk_watermark=None, stream_tools=None,
+        fuse=False, speculate=None, fail_fast=False, harvest_workers=4, max_jobs=None, leases=None, hasher=None,
+        run_log=None):
         if manager is None:
             self.manager = LocalManager()
         else:
             self.manager = manager
+        if history is None:
+            self.history = ToolHistory()
+        else:
+            self.history = history
+        self.disk_watermark = disk_watermark
+        self.stream_tools = stream_tools
+        self.fuse = fuse
+        self.speculate = speculate
+        self.fail_fast = fail_fast
+        self.harvest_workers = harvest_workers
+        self.max_jobs = max_jobs
+        self.leases = leases
+        if hasher is None:
+            hasher = FileHasher()
+        self.hasher = hasher
+        self.run_log = run_log
         self.workdir = os.path.abspath(workdir)
         self.outdir = os.path.abspath(outdir)
         if not os.path.exists(self.workdir):
@@ -240,37 +1468,175 @@ class Engine:
         self.toolbox = toolbox
     
     def run_job(self, workflow, inputs, dryrun=False):
+        return self.run_batch(workflow, [(None, inputs)], dryrun=dryrun)
+
+    def run_batch(self, workflow, input_sets, dryrun=False, overrides=None):
+        """
+        Run the workflow once for each (name, inputs) pair. All the sets share
+        the manager, the harvest pool and the max_jobs slots; a named set writes
+        to its own subdirectory of the outdir and workdir. overrides maps set
+        names to the tool parameters (by step label) changed for that set.
+        Identical jobs, in any of the sets (or, with leases, in any gwftool
+        process sharing the lease dir), are only run once
+        """
+        if overrides is None:
+            overrides = {}
+        self.shared = {}
         print "Workflow inputs: %s" % ",".join(workflow.get_inputs())
-        os.mkdir(os.path.join(self.workdir, "jobs"))
-        state = WorkflowState(outdir=self.outdir, workdir=self.workdir, inputs=inputs, workflow=workflow)
-        
-        for step in workflow.tool_steps():
-            i = state.missing_inputs(step) 
-            if len(i) > 0:
-                raise Exception("Missing inputs: %s" % (",".join(i)))
-        
+        run_log = self.run_log
+        if run_log is None:
+            run_log = os.path.join(self.outdir, "gwftool_run.jsonl")
+        runlog = RunLog(run_log)
+        runlog.write({ "event" : "run_start", "outdir" : self.outdir, "workdir" : self.workdir,
+            "sets" : list(name for name, inputs in input_sets) })
+        pool = ThreadPool(self.harvest_workers)
+        wakeup = threading.Event()
+        states = []
+        for name, inputs in input_sets:
+            outdir, workdir = self.outdir, self.workdir
+            if name is not None:
+                outdir = os.path.join(outdir, name)
+                workdir = os.path.join(workdir, name)
+                for d in [outdir, workdir]:
+                    if not os.path.exists(d):
+                        os.mkdir(d)
+            os.mkdir(os.path.join(workdir, "jobs"))
+            state = WorkflowState(outdir=outdir, workdir=workdir, inputs=inputs, workflow=workflow,
+                history=self.history, stream_tools=self.stream_tools, speculate=self.speculate,
+                harvest_pool=pool, wakeup=wakeup, overrides=overrides.get(name, None), leases=self.leases,
+                hasher=self.hasher, runlog=runlog, name=name)
+            for step in workflow.tool_steps():
+                i = state.missing_inputs(step)
+                if len(i) > 0:
+                    raise Exception("Missing inputs%s: %s" % ("" if name is None else " in set %s" % (name), ",".join(i)))
+            states.append(state)
+
         while True:
             ready_found = False
-            for step in workflow.tool_steps():
-                if state.step_ready(step) and not state.step_running(step) and not state.step_done(step):
-                    print "step", step.step_id, step.inputs, step.input_connections
-                    if step.tool_id not in self.toolbox:
-                        raise Exception("Tool %s not found" % (step.tool_id))
-                    
-                    tool = self.toolbox[step.tool_id]
-                    state.run_job(step, tool, self.manager)
+            for state in states:
+                if self.schedule(state, states):
                     ready_found = True
+            #only packing managers hold jobs back until the end of a pass
+            flush = getattr(self.manager, "flush", None)
+            if flush is not None:
+                flush()
             if not ready_found:
-                if state.has_running():
-                    time.sleep(1)
-                else:
+                running = False
+                for state in states:
+                    state.speculate(self.manager)
+                    if state.has_running():
+                        running = True
+                if not running:
+                    #with no job of ours left to free space, a deferred step that still
+                    #doesn't fit never will
+                    for state in states:
+                        for step_id in sorted(state.deferred):
+                            state.deferred.discard(step_id)
+                            state.fail_step(step_id, "estimated output would pass the disk watermark")
                     break
-        
-        for step in workflow.tool_steps():
-            if not state.step_done(step):
-                print "Not done", step, state.missing_inputs(step)
-                #print state.results
-                for name, conn in step.input_connections.items():
-                    if str(conn['id']) not in state.results:
-                        print "not ready", conn
+                #woken early when an output is committed
+                wakeup.wait(1)
+                wakeup.clear()
+            if self.fail_fast:
+                for state in states:
+                    if len(state.failed) and not state.stopped:
+                        state.cancel()
+        pool.close()
+        pool.join()
+        self.hasher.close()
+        ok = True
+        for (name, inputs), state in zip(input_sets, states):
+            if name is not None:
+                print "Input set %s:" % (name)
+            if not state.summary():
+                ok = False
+        if self.disk_watermark is not None or self.speculate is not None or getattr(self.manager, "pack", False):
+            #only kept between runs for the features that read it
+            self.history.save()
+        runlog.write({ "event" : "run_end", "ok" : ok })
+        runlog.close()
+        return ok
+
+    def free_slots(self, states):
+        if self.max_jobs is None:
+            return None
+        return self.max_jobs - sum(len(s.running) for s in states)
+
+    def schedule(self, state, states):
+        """
+        Launch whatever is ready in one input set, as long as job slots are
+        free. Returns True if anything was launched
+        """
+        launched = False
+        if state.stopped:
+            return launched
+        state.resolve_aliases()
+        if self.leases is not None:
+            state.resolve_leases()
+        for step_id in state.pending_elements():
+            free = self.free_slots(states)
+            if free is not None and free <= 0:
+                break
+            if state.launch_elements(step_id, self.manager, free):
+                launched = True
+        for step in state.workflow.tool_steps():
+            if state.stopped:
+                break
+            if state.step_ready(step) and not state.step_running(step) and not state.step_done(step) \
+                and not state.step_blocked(step):
+                if step.tool_id not in self.toolbox:
+                    raise Exception("Tool %s not found" % (step.tool_id))
+                free = self.free_slots(states)
+                #a stream consumer is exempt from max_jobs: its producer holds a slot
+                #blocked on the pipe until the consumer is started
+                if free is not None and free <= 0 and not state.consumes_stream(step):
+                    continue
 
+                tool = self.toolbox[step.tool_id]
+                try:
+                    width = state.map_width(step.step_id)
+                except ValueError as e:
+                    state.fail_step(str(step.step_id), str(e))
+                    continue
+                key = None
+                if width is None:
+                    key = state.job_key(step, tool)
+                #a step that waited on a lease given up by another process comes back to run it itself
+                if key in self.shared and self.shared[key] != (state, str(step.step_id)):
+                    state.alias(step.step_id, tool, *self.shared[key])
+                    launched = True
+                    continue
+                if not state.reserve_disk(step, tool, self.disk_watermark):
+                    continue
+                if self.leases is not None and key is not None:
+                    lease_key = state.lease_key(step, tool)
+                    status, outputs = self.leases.acquire(lease_key)
+                    if status != "held":
+                        state.reserved.pop(str(step.step_id), None)
+                        if status == "done":
+                            state.reuse_lease(step.step_id, tool, outputs)
+                        else:
+                            state.wait_lease(step.step_id, lease_key, tool)
+                        self.shared[key] = (state, str(step.step_id))
+                        launched = True
+                        continue
+                    state.holding[str(step.step_id)] = lease_key
+                print "step", step.step_id, step.inputs, step.input_connections
+                chain = []
+                if self.fuse and width is None:
+                    chain = state.fusion_chain(step, tool, self.toolbox)
+                    if free is not None:
+                        chain = chain[:free]
+                if width is not None:
+                    state.run_mapped(step, tool, self.manager, width, free)
+                elif len(chain) > 1:
+                    state.run_fused(chain, self.manager)
+                else:
+                    state.run_job(step, tool, self.manager)
+                #outputs passed through a named pipe can't be shared
+                if str(step.step_id) in state.streaming:
+                    state.drop_lease(str(step.step_id))
+                elif key is not None:
+                    self.shared[key] = (state, str(step.step_id))
+                launched = True
+        return launched
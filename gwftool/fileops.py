@@ -0,0 +1,110 @@
+import os
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+import shutil
+
+
+#ioctl cloning a whole file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+COPY_BUFFER = 8 * 1024 * 1024
+KERNEL_COPY_MIN = 1024 * 1024
+
+_libc = None
+
+def libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library("c")
+        _libc = ctypes.CDLL(name, use_errno=True) if name is not None else False
+    return _libc
+
+def kernel_copy(src_fd, dst_fd, size):
+    """
+    Copy size bytes between file descriptors inside the kernel, with
+    copy_file_range or else sendfile (Python 2 has neither in os, so they
+    are called through libc). Returns False if neither is available
+    """
+    lib = libc()
+    if not lib:
+        return False
+    for name in ["copy_file_range", "sendfile"]:
+        func = getattr(lib, name, None)
+        if func is None:
+            continue
+        func.restype = ctypes.c_ssize_t
+        if name == "copy_file_range":
+            func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+            call = lambda n: func(src_fd, None, dst_fd, None, n, 0)
+        else:
+            func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+            call = lambda n: func(dst_fd, src_fd, None, n)
+        copied = 0
+        while copied < size:
+            n = call(min(size - copied, 1024 ** 3))
+            if n < 0:
+                err = ctypes.get_errno()
+                if copied == 0 and err in [errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP]:
+                    break
+                raise OSError(err, os.strerror(err))
+            if n == 0:
+                break
+            copied += n
+        if copied == size:
+            return True
+        if copied > 0:
+            raise IOError("Short copy: %d of %d bytes" % (copied, size))
+    return False
+
+def copy_data(src, dst):
+    """
+    Copy the contents of src to dst, cheapest way first: a reflink (shares
+    the blocks), an in-kernel copy for large files, a buffered copy.
+    Returns the method used
+    """
+    with open(src, "rb") as in_handle:
+        with open(dst, "wb") as out_handle:
+            try:
+                fcntl.ioctl(out_handle.fileno(), FICLONE, in_handle.fileno())
+                return "reflink"
+            except IOError:
+                pass
+            size = os.fstat(in_handle.fileno()).st_size
+            if size >= KERNEL_COPY_MIN and kernel_copy(in_handle.fileno(), out_handle.fileno(), size):
+                return "kernel"
+            shutil.copyfileobj(in_handle, out_handle, COPY_BUFFER)
+            return "copy"
+
+def move_file(src, dst):
+    """
+    Move src onto dst. On the same filesystem this is a single rename, otherwise
+    the data is copied next to dst and renamed over it, so dst never holds a
+    partial file
+    """
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        tmp = dst + ".part"
+        copy_data(src, tmp)
+        os.rename(tmp, dst)
+        os.unlink(src)
+
+def link_file(src, dst):
+    """
+    Hardlink src to dst, copying instead (see copy_data) across
+    filesystems. As with move_file, dst never holds a partial file.
+    Returns the method used
+    """
+    tmp = dst + ".part"
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+        method = "link"
+    except OSError:
+        method = copy_data(src, tmp)
+    os.rename(tmp, dst)
+    return method
@@ -0,0 +1,120 @@
+
+import os
+import json
+import mmap
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def file_digest(path, algorithm="sha1", block_size=BLOCK_SIZE):
+    """
+    Content digest of a file. Regular files are mapped into memory and fed to
+    the hash in large blocks without copying; anything that can't be mapped
+    (empty files, pipes) is read through a large buffer
+    """
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as handle:
+        size = os.fstat(handle.fileno()).st_size
+        if size > 0:
+            try:
+                m = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                m = None
+            if m is not None:
+                try:
+                    for offset in range(0, size, block_size):
+                        h.update(buffer(m, offset, block_size))
+                finally:
+                    m.close()
+                return h.hexdigest()
+        while True:
+            block = handle.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class FileHasher(object):
+    """
+    Computes file digests on a thread pool (hashlib releases the GIL while
+    hashing large blocks). Digests are cached by the file's device and inode,
+    and only reused while its size and mtime are unchanged, so unchanged files
+    are never hashed again. With a cache_dir the cache is also kept on disk,
+    one small file per inode, and shared between runs; nothing is ever written
+    next to the files themselves
+    """
+    def __init__(self, workers=4, algorithm="sha1", cache_dir=None):
+        self.algorithm = algorithm
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def cache_path(self, st):
+        return os.path.join(self.cache_dir, "%d_%d.%s" % (st.st_dev, st.st_ino, self.algorithm))
+
+    def cached(self, st):
+        with self.lock:
+            entry = self.cache.get((st.st_dev, st.st_ino), None)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry[2]
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self.cache_path(st)) as handle:
+                entry = json.loads(handle.read())
+        except (IOError, ValueError):
+            return None
+        if isinstance(entry, dict) and entry.get('size', None) == st.st_size and entry.get('mtime', None) == st.st_mtime:
+            return entry.get('digest', None)
+        return None
+
+    def store(self, st, digest):
+        with self.lock:
+            self.cache[(st.st_dev, st.st_ino)] = (st.st_size, st.st_mtime, digest)
+        if self.cache_dir is None:
+            return
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp = "%s.%d.%d.tmp" % (self.cache_path(st), os.getpid(), threading.current_thread().ident)
+            with open(tmp, "w") as handle:
+                handle.write(json.dumps({ "digest" : digest, "size" : st.st_size, "mtime" : st.st_mtime }))
+            os.rename(tmp, self.cache_path(st))
+        except (IOError, OSError):
+            pass
+
+    def digest(self, path):
+        st = os.stat(path)
+        d = self.cached(st)
+        if d is None:
+            d = file_digest(path, self.algorithm)
+            self.store(st, d)
+        return d
+
+    def digest_many(self, paths):
+        """
+        Returns a dict mapping each path to its digest, hashing uncached files
+        in parallel on a pool shared by every call
+        """
+        paths = sorted(set(paths))
+        if len(paths) < 2 or self.workers < 2:
+            return dict( (p, self.digest(p)) for p in paths )
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+        digests = self.pool.map(self.digest, paths)
+        return dict(zip(paths, digests))
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
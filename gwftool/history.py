@@ -0,0 +1,83 @@
+
+import os
+import json
+
+
+def percentile(values, pct):
+    """
+    nearest-rank percentile of a list of numbers, None if the list is empty
+    """
+    if len(values) == 0:
+        return None
+    s = sorted(values)
+    i = int(round((pct / 100.0) * (len(s) - 1)))
+    return s[i]
+
+
+class ToolHistory(object):
+    """
+    Per tool record of past job measurements (input bytes, output bytes, wall time)
+    used to estimate the cost of future jobs. If a path is given the samples are
+    loaded from, and saved to, a JSON file so they carry over between runs. The
+    file may be shared by several gwftool processes: each one replaces it whole,
+    and a file that can't be read is treated as empty
+    """
+    def __init__(self, path=None, max_samples=100):
+        self.path = path
+        self.max_samples = max_samples
+        self.records = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as handle:
+                    records = json.loads(handle.read())
+            except (IOError, ValueError):
+                records = None
+            if isinstance(records, dict):
+                self.records = records
+
+    def add(self, tool_id, **sample):
+        samples = self.records.setdefault(tool_id, [])
+        samples.append(sample)
+        if len(samples) > self.max_samples:
+            del samples[:len(samples) - self.max_samples]
+
+    def samples(self, tool_id, field):
+        out = []
+        for s in self.records.get(tool_id, []):
+            if s.get(field, None) is not None:
+                out.append(s[field])
+        return out
+
+    def output_ratios(self, tool_id):
+        out = []
+        for s in self.records.get(tool_id, []):
+            if s.get('input_bytes', 0) > 0 and s.get('output_bytes', None) is not None:
+                out.append(float(s['output_bytes']) / s['input_bytes'])
+        return out
+
+    def estimate_output(self, tool_id, input_bytes, default_ratio=1.0):
+        """
+        Estimate the number of bytes a tool will write given the size of its inputs.
+        Uses the 95th percentile of the observed output/input ratios, and never
+        returns less than the 95th percentile of the observed absolute output sizes
+        (which covers tools that take no file input)
+        """
+        ratio = percentile(self.output_ratios(tool_id), 95)
+        if ratio is None:
+            ratio = default_ratio
+        estimate = int(input_bytes * ratio)
+        floor = percentile(self.samples(tool_id, 'output_bytes'), 95)
+        if floor is not None and floor > estimate:
+            estimate = floor
+        return estimate
+
+    def save(self):
+        if self.path is None:
+            return
+        d = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(d):
+            os.makedirs(d)
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "w") as handle:
+            handle.write(json.dumps(self.records))
+        os.rename(tmp, self.path)
@@ -0,0 +1,136 @@
+
+import os
+import json
+import time
+import uuid
+import errno
+import fcntl
+import socket
+import shutil
+
+
+class LeaseDir(object):
+    """
+    Single flight coordination of identical jobs between gwftool processes
+    sharing a directory. A job's key gets a subdirectory, created with an
+    atomic mkdir by the process that runs the job (the holder). The holder
+    touches its heartbeat while the job runs and writes result.json, listing
+    the job's outputs, when it succeeds; on failure it removes the lease so
+    another process can run the job. Leases whose heartbeat is older than
+    timeout seconds, or whose results have gone, are broken and taken over
+    """
+    def __init__(self, path, timeout=60):
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def key_path(self, key, name=None):
+        if name is None:
+            return os.path.join(self.path, key)
+        return os.path.join(self.path, key, name)
+
+    def acquire(self, key):
+        """
+        Returns ("held", None) if this process now holds the lease, ("done", outputs)
+        if another run already produced the outputs, or ("wait", None) if
+        another process is running the job
+        """
+        for attempt in range(2):
+            try:
+                os.mkdir(self.key_path(key))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                result = self.result(key)
+                if result is not None:
+                    return "done", result
+                if not self.stale(key):
+                    return "wait", None
+                self.break_lease(key)
+                continue
+            with open(self.key_path(key, "owner"), "w") as handle:
+                handle.write(json.dumps({ "host" : socket.gethostname(), "pid" : os.getpid(), "time" : time.time() }))
+            self.heartbeat(key)
+            return "held", None
+        return "wait", None
+
+    def heartbeat(self, key):
+        with open(self.key_path(key, "heartbeat"), "w") as handle:
+            handle.write(str(time.time()))
+
+    def publish(self, key, outputs):
+        """
+        outputs maps output names to File records
+        """
+        tmp = self.key_path(key, "result.json.tmp")
+        with open(tmp, "w") as handle:
+            handle.write(json.dumps(outputs))
+        os.rename(tmp, self.key_path(key, "result.json"))
+
+    def release(self, key):
+        self.remove(key)
+
+    def result(self, key):
+        """
+        The published outputs of a key, None if there are none or any of
+        the files is gone
+        """
+        path = self.key_path(key, "result.json")
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as handle:
+                outputs = json.loads(handle.read())
+        except (IOError, ValueError):
+            return None
+        for v in outputs.values():
+            if not os.path.exists(v['path']):
+                return None
+        return outputs
+
+    def stale(self, key):
+        if not os.path.exists(self.key_path(key)):
+            return True
+        if os.path.exists(self.key_path(key, "result.json")):
+            #published, but the outputs are gone
+            return self.result(key) is None
+        path = self.key_path(key, "heartbeat")
+        if not os.path.exists(path):
+            #the holder may still be writing it
+            path = self.key_path(key)
+        try:
+            return time.time() - os.path.getmtime(path) > self.timeout
+        except OSError:
+            return True
+
+    def break_lease(self, key):
+        """
+        Remove a stale lease. Processes breaking the same key take turns through
+        a lock file and check the lease is still stale once they hold it, so a
+        lease another process has just broken and taken over again is left alone.
+        Returns True if the lease was broken
+        """
+        with open(os.path.join(self.path, "%s.lock" % (key)), "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                if not self.stale(key):
+                    return False
+                self.remove(key)
+                return True
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def remove(self, key):
+        """
+        The lease is renamed away before it is deleted, so its key is free
+        at once and a half deleted lease is never seen under it
+        """
+        tmp = os.path.join(self.path, "%s.broken.%s" % (key, uuid.uuid4().hex))
+        try:
+            os.rename(self.key_path(key), tmp)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        shutil.rmtree(tmp, ignore_errors=True)
@@ -0,0 +1,174 @@
+
+import os
+import sys
+import json
+import time
+import threading
+import argparse
+
+from gwftool.history import percentile
+
+
+BLOB_FIELDS = ['stdout', 'stderr', 'script']
+
+
+def epoch(dt):
+    if dt is None:
+        return None
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1000000.0
+
+
+class RunLog(object):
+    """
+    Append only JSON lines log of a run: one record per line, with an 'event'
+    field (run_start, job, step_failed, summary, run_end). Records are
+    flushed and fsync'd in batches, every sync_records records or
+    sync_seconds seconds, rather than one by one. Job stdout, stderr and
+    scripts larger than blob_bytes are written to files in <log>.blobs and
+    replaced in the record by {"blob" : <path relative to the log>, "bytes" : n}
+    """
+    def __init__(self, path, sync_records=100, sync_seconds=5.0, blob_bytes=64*1024):
+        self.path = os.path.abspath(path)
+        self.blob_dir = self.path + ".blobs"
+        self.sync_records = sync_records
+        self.sync_seconds = sync_seconds
+        self.blob_bytes = blob_bytes
+        self.handle = open(self.path, "a")
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.blob_count = 0
+
+    def spill(self, record):
+        for field in BLOB_FIELDS:
+            value = record.get(field, None)
+            if isinstance(value, basestring) and len(value) > self.blob_bytes:
+                if not os.path.exists(self.blob_dir):
+                    os.mkdir(self.blob_dir)
+                self.blob_count += 1
+                name = "%d.%d.%s" % (os.getpid(), self.blob_count, field)
+                with open(os.path.join(self.blob_dir, name), "w") as handle:
+                    handle.write(value)
+                record[field] = { "blob" : os.path.join(os.path.basename(self.blob_dir), name), "bytes" : len(value) }
+
+    def write(self, record):
+        record.setdefault("time", time.time())
+        with self.lock:
+            self.spill(record)
+            self.handle.write(json.dumps(record) + "\n")
+            self.unsynced += 1
+            if self.unsynced >= self.sync_records or time.time() - self.last_sync >= self.sync_seconds:
+                self.sync()
+
+    def sync(self):
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.handle.close()
+
+
+def read_log(path):
+    with open(path) as handle:
+        for line in handle:
+            line = line.strip()
+            if len(line):
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    #the last line of a run that was killed may be cut short
+                    pass
+
+
+def blob_text(path, value):
+    """
+    The text of a record field, reading it from the blob file it was spilled to
+    """
+    if isinstance(value, dict) and 'blob' in value:
+        blob = os.path.join(os.path.dirname(os.path.abspath(path)), value['blob'])
+        if not os.path.exists(blob):
+            return ""
+        with open(blob) as handle:
+            return handle.read()
+    if value is None:
+        return ""
+    return value
+
+
+def job_failed(job):
+    """
+    A job without an exit code never ran, or was cut off, it isn't counted as failed
+    """
+    return job.get('exitcode', None) not in [0, None]
+
+
+def report(path, slowest=10, out=sys.stdout):
+    """
+    Summarise the jobs, timing and failures recorded in a run log
+    """
+    jobs = []
+    failures = []
+    summaries = []
+    for record in read_log(path):
+        if record['event'] == 'job':
+            jobs.append(record)
+        elif record['event'] == 'step_failed':
+            failures.append(record)
+        elif record['event'] == 'summary':
+            summaries.append(record)
+
+    starts = list(j['start'] for j in jobs if j.get('start', None) is not None)
+    ends = list(j['end'] for j in jobs if j.get('end', None) is not None)
+    elapsed = max(ends) - min(starts) if len(starts) and len(ends) else 0.0
+    walls = list(j['wallSeconds'] for j in jobs if j.get('wallSeconds', None) is not None)
+    out.write("%s: %d jobs, %d failed, %d without exit code, %.1f job seconds over %.1f seconds\n" % (path, len(jobs),
+        len(list(j for j in jobs if job_failed(j))), len(list(j for j in jobs if j.get('exitcode', None) is None)),
+        sum(walls), elapsed))
+
+    tools = {}
+    for j in jobs:
+        tools.setdefault(j['tool'], []).append(j)
+    out.write("\n%-30s %6s %6s %10s %10s %10s %10s\n" % ("tool", "jobs", "failed", "total_s", "mean_s", "p95_s", "max_s"))
+    for tool in sorted(tools):
+        t_walls = list(j['wallSeconds'] for j in tools[tool] if j.get('wallSeconds', None) is not None)
+        failed = len(list(j for j in tools[tool] if job_failed(j)))
+        if len(t_walls):
+            out.write("%-30s %6d %6d %10.1f %10.1f %10.1f %10.1f\n" % (tool, len(tools[tool]), failed, sum(t_walls),
+                sum(t_walls) / len(t_walls), percentile(t_walls, 95), max(t_walls)))
+        else:
+            out.write("%-30s %6d %6d %10s %10s %10s %10s\n" % (tool, len(tools[tool]), failed, "-", "-", "-", "-"))
+
+    timed = sorted((j for j in jobs if j.get('wallSeconds', None) is not None), key=lambda j: -j['wallSeconds'])
+    if len(timed):
+        out.write("\nslowest jobs:\n")
+        for j in timed[:slowest]:
+            out.write("  %8.1fs  %s step %s (%s)\n" % (j['wallSeconds'], j.get('set', None) or "-", j['job'], j['tool']))
+
+    if len(failures):
+        out.write("\nfailures:\n")
+        for f in failures:
+            out.write("  %s step %s: %s\n" % (f.get('set', None) or "-", f['step'], f['reason']))
+            for j in jobs:
+                if j.get('set', None) == f.get('set', None) and j['step'] == f['step'] and job_failed(j):
+                    stderr = blob_text(path, j.get('stderr', None)).strip().split("\n")
+                    if len(stderr) and len(stderr[-1]):
+                        out.write("      job %s stderr: %s\n" % (j['job'], stderr[-1]))
+
+    if len(summaries):
+        out.write("\n%-20s %8s %6s %6s %7s\n" % ("set", "status", "done", "failed", "skipped"))
+        for s in summaries:
+            out.write("%-20s %8s %6d %6d %7d\n" % (s.get('set', None) or "-", "ok" if s['ok'] else "failed",
+                s['done'], len(s['failed']), len(s['skipped'])))
+
+
+def report_main(args):
+    parser = argparse.ArgumentParser(prog="gwftool report")
+    parser.add_argument("--slowest", type=int, default=10, help="Number of slowest jobs listed")
+    parser.add_argument("log")
+    args = parser.parse_args(args)
+    report(args.log, slowest=args.slowest)
+    return 0
@@ -1,4 +1,30 @@
 
+import os
+import json
+import time
+import Queue
+import inspect
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from gwftool.hashing import FileHasher
+from gwftool.workflow_io import GalaxyWorkflow
+from gwftool.warpdrive import RemoteGalaxy, LibraryIndex, GalaxyPool, GalaxyMember, TERMINAL_STATES
+from gwftool.warpdrive import run_up, run_up_pool, run_down, pool_names, web_wait, library_paste_sync
+from gwftool.fileops import link_file
+
+
+def dataset_checksum(meta):
+    """
+    (algorithm, hexdigest) of a dataset from the hashes Galaxy recorded
+    for it, None if there are none
+    """
+    for h in meta.get('hashes', None) or []:
+        alg = h.get('hash_function', "").replace("-", "").lower()
+        if alg in ['md5', 'sha1', 'sha256', 'sha512']:
+            return (alg, h['hash_value'])
+    return None
 
 class WorkflowRunner:
     
@@ -17,8 +43,47 @@ class WorkflowRunner:
         #'docker_user' : '1450'
     }
     
-    def __init__(self, docbase):
+    def __init__(self, docbase, poll_min=1.0, poll_max=30.0, workers=4, launch_docker=False, fanout_workers=10,
+        docstore=None, target_class=None, hda_class=None):
         self.config = self.inside_config_defaults
+        self.docbase = docbase
+        #the doc store task inputs are read from, and the classes naming its
+        #documents: target_class(id) for an input, hda_class(meta) for a stored output
+        self.docstore = docstore
+        self.target_class = target_class
+        self.hda_class = hda_class
+        self.launch_docker = launch_docker
+        self.rg = None
+        self.galaxies = None
+        #job_id -> the Galaxy it was dispatched to, until it finishes and its outputs are stored
+        self.dispatched = {}
+        #job_id -> (galaxy name, dataset id) of its outputs not stored yet
+        self.storing = {}
+        #(galaxy name, dataset id) -> job_id, the reverse of storing
+        self.unstored = {}
+        #Galaxy containers shut down after draining
+        self.stopped = set()
+        #number of tasks uploaded and invoked at the same time
+        self.workers = workers
+        #job_id -> job, waiting or being prepared
+        self.queue = {}
+        #job_id -> job, invoked
+        self.active = {}
+        self.queue_lock = threading.Lock()
+        self.tasks = Queue.Queue()
+        self.index_lock = threading.Lock()
+        self.workflow_lock = threading.Lock()
+        self.running = True
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        #(galaxy url, history, hda) -> last seen metadata, terminal ones are never polled again
+        self.hda_states = {}
+        #job_id -> (next poll time, poll interval)
+        self.polls = {}
+        #the per dataset work of store_data_many and get_meta_many, kept off the clients' pools
+        self.fanout_workers = fanout_workers
+        self.fanout = None
+        self.fanout_lock = threading.Lock()
     
     def to_dict(self):
         return self.config
@@ -39,9 +104,7 @@ class WorkflowRunner:
 
 
     def runEngine(self):
-        web_wait(self.config['url'], 120)
-        
-        self.config['lib_data'] = [docbase]
+        self.config['lib_data'] = [self.docbase]
         """
         if 'lib_data' in self.config:
             self.config['lib_data'].append(self.docstore.local_cache_base())
@@ -49,136 +112,412 @@ class WorkflowRunner:
             self.config['lib_data'] = [self.docstore.local_cache_base()]
         """
         
+        #one or more Galaxy instances, tasks are spread across them (see GalaxyPool)
         if self.launch_docker:
             print "running config", self.config
-            self.rg = run_up(**self.config)
+            rgs = run_up_pool(**self.launch_config())
+            names = pool_names(self.config.get('name', 'galaxy'), len(rgs))
         else:
             common_dir_map = {}
             if self.launch_docker and 'common_dirs' in self.config:
                 for c in self.config['common_dirs']:
                     common_dir_map[c] = c
-            self.rg = RemoteGalaxy(self.config['url'],
-                                   self.config['api_key'],
-                                   path_mapping=common_dir_map
-                                  )
+            rgs = []
+            names = self.config.get('urls', [self.config['url']])
+            for url in names:
+                web_wait(url, 120)
+                #a connection for every task worker, on top of the client's own fan out pool
+                rgs.append(RemoteGalaxy(url,
+                                       self.config['api_key'],
+                                       path_mapping=common_dir_map,
+                                       pool_size=10 + self.workers,
+                                       workers=10
+                                      ))
 
-        library_paste_sync(self.rg, [], {})
-
-        library_id = self.rg.library_find("Imported")['id']
-        folder_id = self.rg.library_find_contents(library_id, "/")['id']
+        members = []
+        for name, rg in zip(names, rgs):
+            library_paste_sync(rg, [], {})
+            m = GalaxyMember(name, rg)
+            m.library_id = rg.library_find("Imported")['id']
+            m.folder_id = rg.library_find_contents(m.library_id, "/")['id']
+            members.append(m)
+        self.galaxies = GalaxyPool(members, policy=self.config.get('dispatch', 'hash'))
+        self.rg = rgs[0]
+        self.library_index = LibraryIndex(self.config.get('library_index', None))
+        self.hasher = FileHasher(cache_dir=self.config.get('digest_cache', None))
 
         self.ready = True
 
         logging.info("Galaxy Running")
-        while self.running:
-            time.sleep(3)
-            req = self.get_queued()
-            if req is not None:
-                logging.info("Received task request")
-                uuid_ldda_map = {}
-                with self.queue_lock:
-                    job_id, job = req
-                    wids = []
-                    for k, v in job.get_inputs().items():
-                        file_path = self.docstore.get_filename(Target(v.id))
-                        file_meta = self.docstore.get(v.id)
-                        file_name = v.id
-                        if 'name' in file_meta:
-                            file_name = file_meta['name']
-                        logging.info("Loading FilePath: %s (%s) %s" % (v.id, file_name, file_path))
-                        nli = self.rg.library_paste_file(library_id=library_id,
-                                                         library_folder_id=folder_id,
-                                                         name=file_name,
-                                                         datapath=file_path,
-                                                         uuid=v.uuid)
-                        if 'id' not in nli:
-                            raise Exception("Failed to load data %s: %s" % (k, str(nli)))
-                        wids.append(nli['id'])
-                        uuid_ldda_map[v.uuid] = nli['id']
-
-                    #wait for the uploading of the files to finish
-                    while True:
-                        done = True
-                        for w in wids:
-                            d = self.rg.library_get_contents(library_id, w)
-                            if d['state'] == 'error':
-                                raise Exception("Data loading Error")
-                            if d['state'] != 'ok':
-                                logging.debug("Data loading: %s" % (d['state']))
-                                done = False
-                                break
-                        if done:
-                            break
-                        time.sleep(2)
-
-                    workflow_data = job.task.to_dict()['workflow']
-                    logging.info("Loading Workflow: %s" % (workflow_data['uuid']))
-                    self.rg.add_workflow(workflow_data)
-                    wf = GalaxyWorkflow(workflow_data)
-                    print "uuid_map", uuid_ldda_map
-                    request = job.task.get_workflow_request(uuid_ldda_map)
-                    print "Calling Workflow", json.dumps(request)
-                    invc = self.rg.call_workflow(request=request)
-                    print "Called Workflow", json.dumps(invc)
-                    if 'err_msg' in invc:
-                        logging.error("Workflow invocation failed")
-                        job.set_error("Workflow Invocation Failed")
-                    else:
-                        job.history = invc['history']
-                        job.instance_id = invc['uuid']
-                        job.outputs = {}
-                        job.hidden = {}
-                        wf_outputs = wf.get_outputs()
-                        for step in invc['steps']:
-                            if 'outputs' in step:
-                                if step['workflow_step_label'] is not None:
-                                    step_name = step['workflow_step_label']
-                                else:
-                                    step_name = str(step['workflow_step_uuid'])
-                                for ok, ov in step['outputs'].items():
-                                    output_name = "%s|%s" % (step_name, ok)
-                                    if output_name in wf_outputs: #filter out produced items that are not part of the final output
-                                        job.outputs[ output_name ] = ov
-                                    else:
-                                        job.hidden[ output_name ] = ov
+        health = threading.Thread(target=self.health_worker)
+        health.daemon = True
+        health.start()
+        workers = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self.task_worker)
+            t.daemon = True
+            t.start()
+            workers.append(t)
+        for t in workers:
+            t.join()
+        health.join()
 
+        with self.fanout_lock:
+            if self.fanout is not None:
+                self.fanout.close()
+                self.fanout.join()
+                self.fanout = None
+        for m in self.galaxies.members:
+            logging.info("Galaxy %s API cache: %s" % (m.name, json.dumps(m.rg.cache_stats())))
         down_config = {}
         #if "work_dir" in self.config:
         #    down_config['work_dir'] = self.config['work_dir']
         if self.launch_docker:
-            run_down(name=self.config['name'], rm=True, sudo=self.config.get("sudo", False), **down_config)
+            for m in self.galaxies.members:
+                if m.name not in self.stopped:
+                    run_down(name=m.name, rm=True, sudo=self.config.get("sudo", False), **down_config)
+
+    def launch_config(self):
+        """
+        The run_up arguments (and the number of instances) set in the config,
+        which also holds the runner's own settings. 'galaxy' is left out, it
+        names the image the runner itself runs in (see get_docker_image)
+        """
+        names = set(inspect.getargspec(run_up).args + ['instances'])
+        names.discard('galaxy')
+        return dict( (k, v) for k, v in self.config.items() if k in names )
+
+    def health_worker(self):
+        """
+        Checks the health of the Galaxy instances, and shuts down drained
+        ones, until the runner stops
+        """
+        interval = self.config.get('health_interval', 30)
+        last = time.time()
+        while self.running:
+            time.sleep(1)
+            if time.time() - last < interval:
+                continue
+            last = time.time()
+            self.galaxies.check()
+            for m in self.galaxies.members:
+                if m.draining and m.load == 0 and m.name not in self.stopped:
+                    logging.info("Galaxy %s drained" % (m.name))
+                    self.stopped.add(m.name)
+                    if self.launch_docker:
+                        run_down(name=m.name, rm=True, sudo=self.config.get("sudo", False))
+
+    def drain(self, name):
+        """
+        Stops sending tasks to a Galaxy instance, it is shut down once the
+        tasks it has finish
+        """
+        self.galaxies.drain(name)
+
+    def finish(self, job_id):
+        """
+        Forgets a finished job's poll state. Its slot on its Galaxy is freed
+        once its outputs are stored (see stored), or at once if it failed or
+        has none, so a drained Galaxy is not shut down before they are
+        """
+        self.polls.pop(job_id, None)
+        job = self.get_job(job_id)
+        outputs = []
+        if job is not None and getattr(job, 'history', None) is not None:
+            for data in job.get_outputs(all=True).values():
+                self.hda_states.pop((job.galaxy.rg.url, job.history, data['id']), None)
+            if job.state == "ok":
+                outputs = list((ov['galaxy'], ov['id']) for ov in job.outputs.values())
+        with self.queue_lock:
+            if job_id in self.storing or job_id not in self.dispatched:
+                return
+            if len(outputs):
+                self.storing[job_id] = set(outputs)
+                for key in outputs:
+                    self.unstored[key] = job_id
+                return
+            member = self.dispatched.pop(job_id)
+        self.galaxies.release(member)
+
+    def stored(self, objects):
+        """
+        Frees the slot of every job whose outputs have now all been stored
+        """
+        released = []
+        with self.queue_lock:
+            for o in objects:
+                key = (o.get('galaxy', None), o['id'])
+                job_id = self.unstored.pop(key, None)
+                if job_id is None:
+                    continue
+                pending = self.storing[job_id]
+                pending.discard(key)
+                if len(pending) == 0:
+                    del self.storing[job_id]
+                    released.append(self.dispatched.pop(job_id))
+        for member in released:
+            self.galaxies.release(member)
+
+    def galaxy(self, object):
+        """
+        The client of the Galaxy a dataset record (from job outputs) is on
+        """
+        if 'galaxy' in object:
+            return self.galaxies.get(object['galaxy']).rg
+        return self.rg
+
+    def map(self, func, items):
+        """
+        Calls func on every item concurrently, returns the results in order.
+        Runs on the runner's own pool, so func may use RemoteGalaxy.map
+        """
+        items = list(items)
+        if len(items) < 2 or self.fanout_workers < 2:
+            return list(func(i) for i in items)
+        with self.fanout_lock:
+            if self.fanout is None:
+                self.fanout = ThreadPool(self.fanout_workers)
+        return self.fanout.map(func, items)
+
+    def submit(self, job_id, job):
+        """
+        Queues a task, the next free worker picks it up
+        """
+        with self.queue_lock:
+            self.queue[job_id] = job
+        self.tasks.put(job_id)
+
+    def stop(self):
+        """
+        Workers finish the tasks already queued, then runEngine shuts down
+        """
+        self.running = False
+        for i in range(self.workers):
+            self.tasks.put(None)
+
+    def get_job(self, job_id):
+        with self.queue_lock:
+            return self.active.get(job_id, None) or self.queue.get(job_id, None)
+
+    def task_worker(self):
+        while True:
+            job_id = self.tasks.get()
+            if job_id is None:
+                return
+            with self.queue_lock:
+                job = self.queue[job_id]
+            logging.info("Received task request")
+            try:
+                self.run_task(job_id, job)
+            except Exception, e:
+                logging.exception("Task %s failed" % (job_id))
+                job.set_error(str(e))
+                self.finish(job_id)
+            with self.queue_lock:
+                del self.queue[job_id]
+                self.active[job_id] = job
+
+    def run_task(self, job_id, job):
+        """
+        Loads the inputs of a task into the library of a Galaxy and invokes
+        its workflow there. A task goes to the Galaxy that already holds the
+        most of its inputs (by the library index), otherwise to where its
+        largest input hashes, so tasks sharing a reference input land together
+        """
+        paths = {}
+        inputs = job.get_inputs()
+        for k, v in inputs.items():
+            paths[k] = self.docstore.get_filename(self.target_class(v.id))
+        affinity = {}
+        with self.index_lock:
+            for m in self.galaxies.members:
+                affinity[m.name] = len(list(v for v in inputs.values()
+                    if self.library_index.find(m.rg, m.library_id, uuid=v.uuid) is not None))
+        key = None
+        if len(inputs):
+            key = inputs[max(inputs, key=lambda k: os.path.getsize(paths[k]))].uuid
+        member = self.galaxies.acquire(key, affinity)
+        with self.queue_lock:
+            self.dispatched[job_id] = member
+        job.galaxy = member
+        rg = member.rg
+        logging.info("Dispatching task %s to Galaxy %s" % (job_id, member.name))
+
+        uuid_ldda_map = {}
+        #skip inputs already imported by an earlier task, by uuid or content. The
+        #listing is taken under the lock entries are added under, so it holds every
+        #dataset in the index and validate only drops the ones that are gone or failed
+        with self.index_lock:
+            self.library_index.validate(rg, member.library_id, rg.library_folder_contents(member.folder_id))
+        inputs = []
+        files = []
+        for k, v in job.get_inputs().items():
+            file_path = paths[k]
+            digest = None
+            with self.index_lock:
+                found = self.library_index.find(rg, member.library_id, uuid=v.uuid)
+            if found is None:
+                #only inputs not imported under their own uuid are hashed, to find a copy of the same content
+                digest = self.hasher.digest(file_path)
+                with self.index_lock:
+                    found = self.library_index.find(rg, member.library_id, digest=digest)
+            if found is not None:
+                logging.info("Already loaded: %s as %s" % (v.id, found))
+                uuid_ldda_map[v.uuid] = found
+                continue
+            file_meta = self.docstore.get(v.id)
+            file_name = v.id
+            if 'name' in file_meta:
+                file_name = file_meta['name']
+            logging.info("Loading FilePath: %s (%s) %s" % (v.id, file_name, file_path))
+            inputs.append((k, v, digest))
+            files.append({'name' : file_name, 'datapath' : file_path, 'uuid' : v.uuid})
+        wids = []
+        for (k, v, digest), nli in zip(inputs, rg.library_paste_files(member.library_id, member.folder_id, files)):
+            if 'id' not in nli:
+                raise Exception("Failed to load data %s: %s" % (k, str(nli)))
+            wids.append(nli['id'])
+            uuid_ldda_map[v.uuid] = nli['id']
+
+        #wait for the uploading of the files to finish
+        rg.library_wait(member.library_id, member.folder_id, wids, timeout=self.config.get('upload_timeout', 600))
+        with self.index_lock:
+            for (k, v, digest), w in zip(inputs, wids):
+                self.library_index.add(rg, member.library_id, w, uuid=v.uuid, digest=digest)
+            self.library_index.save()
+
+        workflow_data = job.task.to_dict()['workflow']
+        with self.workflow_lock:
+            #tasks of the same workflow upload it once to each Galaxy
+            if workflow_data['uuid'] not in member.workflows:
+                logging.info("Loading Workflow: %s" % (workflow_data['uuid']))
+                rg.add_workflow(workflow_data)
+                member.workflows.add(workflow_data['uuid'])
+        wf = GalaxyWorkflow(workflow_data)
+        print "uuid_map", uuid_ldda_map
+        request = job.task.get_workflow_request(uuid_ldda_map)
+        print "Calling Workflow", json.dumps(request)
+        invc = rg.call_workflow(request=request)
+        print "Called Workflow", json.dumps(invc)
+        if 'err_msg' in invc:
+            logging.error("Workflow invocation failed")
+            job.set_error("Workflow Invocation Failed")
+        else:
+            job.history = invc['history']
+            job.instance_id = invc['uuid']
+            job.outputs = {}
+            job.hidden = {}
+            wf_outputs = wf.get_outputs()
+            for step in invc['steps']:
+                if 'outputs' in step:
+                    if step['workflow_step_label'] is not None:
+                        step_name = step['workflow_step_label']
+                    else:
+                        step_name = str(step['workflow_step_uuid'])
+                    for ok, ov in step['outputs'].items():
+                        ov['galaxy'] = member.name
+                        output_name = "%s|%s" % (step_name, ok)
+                        if output_name in wf_outputs: #filter out produced items that are not part of the final output
+                            job.outputs[ output_name ] = ov
+                        else:
+                            job.hidden[ output_name ] = ov
 
     def status(self, job_id):
         if job_id in self.active:
-            if self.rg is not None:
+            if self.galaxies is not None:
                 job = self.get_job(job_id)
-                if job.state == 'error':
-                    return "error"
+                if job.state in ["ok", "error"]:
+                    self.finish(job_id)
+                    return job.state
+                next_poll, interval = self.polls.get(job_id, (0, self.poll_min))
+                if time.time() < next_poll:
+                    return job.state
                 ready = True
+                rg = job.galaxy.rg
+                changed = self.poll_history(rg, job.history, list(data['id'] for data in job.get_outputs(all=True).values()))
                 for outputname, data in job.get_outputs(all=True).items():
-                    meta = self.rg.get_hda(job.history, data['id'])
-                    if meta['state'] == 'error':
-                        job.set_error(meta['misc_info'])
-                    if meta['state'] != 'ok':
+                    meta = self.hda_states.get((rg.url, job.history, data['id']), {})
+                    if meta.get('state', None) == 'error':
+                        job.set_error(meta.get('misc_info', None))
+                    if meta.get('state', None) != 'ok':
                         ready = False
                 if ready:
                     job.state = "ok"
+                if job.state in ["ok", "error"]:
+                    self.finish(job_id)
+                #poll quickly while datasets are changing state, back off while nothing happens
+                interval = self.poll_min if changed else min(interval * 1.5, self.poll_max)
+                self.polls[job_id] = (time.time() + interval, interval)
                 return job.state
             return "waiting"
         elif job_id in self.queue:
             return "waiting"
         return "unknown"
 
+    def poll_history(self, rg, history, hdas):
+        """
+        Refreshes the states of the given datasets of a history with a single
+        listing of the history, skipping datasets already in a terminal state.
+        Returns True if any state changed
+        """
+        pending = list(h for h in hdas if self.hda_states.get((rg.url, history, h), {}).get('state', None) not in TERMINAL_STATES)
+        if len(pending) == 0:
+            return False
+        contents = dict( (c['id'], c) for c in rg.get_history_contents(history) )
+        missing = list(h for h in pending if h not in contents)
+        if len(missing):
+            #not in the listing (e.g. purged or hidden from it), ask for them directly
+            contents.update(rg.get_hdas(history, missing))
+        changed = False
+        for h in pending:
+            meta = contents.get(h, None)
+            if meta is None:
+                continue
+            if meta.get('state', None) != self.hda_states.get((rg.url, history, h), {}).get('state', None):
+                changed = True
+            self.hda_states[(rg.url, history, h)] = meta
+        return changed
+
     def store_data(self, object, doc_store):
-        meta = self.rg.get_dataset(object['id'], object['src'])
-        print "Storing", meta
-        meta['id'] = meta['uuid'] #use the glocal id
-        hda = HDATarget(meta)
-        doc_store.create(hda)
-        path = doc_store.get_filename(hda)
-        shutil.copy(meta['file_name'], path)
-        #self.rg.download(meta['download_url'], path)
-        doc_store.update_from_file(hda)
+        self.store_data_many([object], doc_store)
+
+    def store_data_many(self, objects, doc_store):
+        """
+        Stores datasets in the doc store. Files visible on this host are
+        hardlinked (or reflinked, or copied, see link_file), the others are
+        downloaded, all concurrently
+        """
+        metas = self.map(lambda o: self.galaxy(o).get_dataset(o['id'], o['src']), objects)
+        imports = []
+        downloads = {}
+        stored = []
+        for o, meta in zip(objects, metas):
+            print "Storing", meta
+            meta['id'] = meta['uuid'] #use the glocal id
+            hda = self.hda_class(meta)
+            doc_store.create(hda)
+            path = doc_store.get_filename(hda)
+            if os.path.exists(meta.get('file_name', None) or ""):
+                imports.append((meta['file_name'], path))
+            else:
+                downloads.setdefault(self.galaxy(o), []).append((meta['download_url'], path, dataset_checksum(meta)))
+            stored.append(hda)
+
+        def import_file(i):
+            start = time.time()
+            method = link_file(i[0], i[1])
+            size = os.path.getsize(i[1])
+            logging.info("Imported %s: %d bytes by %s in %.2fs" % (i[0], size, method, time.time() - start))
+            return size
+        start = time.time()
+        sizes = self.map(import_file, imports)
+        for rg, d in downloads.items():
+            sizes += rg.download_many(d)
+        elapsed = max(time.time() - start, 0.001)
+        logging.info("Stored %d datasets: %d bytes in %.2fs (%.1f MB/s)" % (len(stored), sum(sizes), elapsed, sum(sizes) / elapsed / (1024 * 1024)))
+        for hda in stored:
+            doc_store.update_from_file(hda)
+        self.stored(objects)
 
     def store_meta(self, object, doc_store):
         """
@@ -189,9 +528,21 @@ class WorkflowRunner:
     def get_meta(self, object):
         """
         """
-        meta = self.rg.get_dataset(object['id'], object['src'])
-        prov = self.rg.get_provenance(meta['history_id'], object['id'])
+        rg = self.galaxy(object)
+        meta = rg.get_dataset(object['id'], object['src'])
+        prov = rg.get_provenance(meta['history_id'], object['id'])
         meta['provenance'] = prov
         meta['id'] = meta['uuid']
-        meta['job'] = self.rg.get_job(prov['job_id'])
+        meta['job'] = rg.get_job(prov['job_id'])
         return meta
+
+    def get_meta_many(self, objects):
+        """
+        get_meta of many datasets. The calls for one dataset depend on each
+        other, so the datasets are fetched concurrently instead
+        """
+        return self.map(self.get_meta, objects)
+
+    def store_meta_many(self, objects, doc_store):
+        for meta in self.get_meta_many(objects):
+            doc_store.put(meta['uuid'], meta)
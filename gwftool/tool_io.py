@@ -97,6 +97,8 @@ class CMDFilter(Filter):
                 return val['path']
         if isinstance(val, ToolOutput):
             return val.name
+        if isinstance(val, (int, long, float)):
+            return str(val)
         return val
 
 class GalaxyTool(object):
@@ -8,15 +8,26 @@ import argparse
 import subprocess
 import logging
 import requests
+import requests.adapters
 import json
+import copy
+import bisect
 import shutil
+import hashlib
 import jinja2
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 try:
     import yaml
 except ImportError:
     yaml = None
 
+from requests.packages.urllib3.util.retry import Retry
+
+from gwftool.hashing import file_digest
+
 from xml.dom.minidom import parse as parseXML
 from glob import glob
 from socket import gethostname
@@ -341,12 +352,12 @@ def web_wait(url, timeout=60):
 def library_paste_sync(rg, data_load, meta_data):
     library_id = rg.create_library("Imported")
     folder_id = rg.library_find_contents(library_id, "/")['id']
+    files = []
     for data in data_load:
         logging.info("Loading: %s" % (data))
-        md = {}
-        if data in meta_data:
-            md = meta_data[data]
-        rg.library_paste_file(library_id, folder_id, os.path.basename(data), data, uuid=md.get('uuid', None))
+        md = meta_data.get(data, {})
+        files.append({'name' : os.path.basename(data), 'datapath' : data, 'uuid' : md.get('uuid', None)})
+    rg.library_paste_files(library_id, folder_id, files)
 
 
 def run_up(name="galaxy", galaxy="bgruening/galaxy-stable", port=8080, host=None,
@@ -500,14 +511,7 @@ def run_up(name="galaxy", galaxy="bgruening/galaxy-stable", port=8080, host=None
             pass
 
     rg = RemoteGalaxy("http://%s:%s"  % (web_host, port), 'admin', path_mapping=lib_mapping)
-    library_id = rg.create_library("Imported")
-    folder_id = rg.library_find_contents(library_id, "/")['id']
-    for data in data_load:
-        logging.info("Loading: %s" % (data))
-        md = {}
-        if data in meta_data:
-            md = meta_data[data]
-        rg.library_paste_file(library_id, folder_id, os.path.basename(data), data, uuid=md.get('uuid', None))
+    library_paste_sync(rg, data_load, meta_data)
 
     with open(os.path.join(config_dir, "config.json"), "w") as handle:
         handle.write(json.dumps({
@@ -532,24 +536,175 @@ def run_up(name="galaxy", galaxy="bgruening/galaxy-stable", port=8080, host=None
 
     return rg
 
-class RemoteGalaxy(object):
+#dataset and job states that will not change again
+TERMINAL_STATES = ['ok', 'error', 'discarded', 'failed_metadata']
+JOB_TERMINAL_STATES = ['ok', 'error', 'deleted', 'failed']
+
+DOWNLOAD_BUFFER = 4 * 1024 * 1024
+SEGMENT_MIN = 256 * 1024 * 1024
+
+def content_total(r):
+    """
+    Size of the whole file a download response is (part of), None if unknown
+    """
+    if r.status_code in [206, 416]:
+        total = r.headers.get('Content-Range', '').split('/')[-1]
+        return long(total) if total.isdigit() else None
+    if 'Content-Length' in r.headers:
+        return long(r.headers['Content-Length'])
+    return None
+
+def part_info(part):
+    """
+    What a .part file is a download of (see RemoteGalaxy.download), None if
+    that wasn't recorded
+    """
+    try:
+        with open(part + ".json") as handle:
+            info = json.loads(handle.read())
+    except (IOError, ValueError):
+        return None
+    return info if isinstance(info, dict) else None
+
+def remove_part(part):
+    for p in [part, part + ".json"]:
+        if os.path.exists(p):
+            os.unlink(p)
+
+def dataset_done(meta):
+    return meta.get('state', None) in TERMINAL_STATES
+
+def galaxy_session(pool_size=10, retries=3, backoff=0.5):
+    """
+    A keep-alive session with a connection pool of pool_size connections.
+    Connection errors are retried on every method (the request never reached
+    the server), 5xx responses and read errors only on GET, so POSTs that
+    create libraries or invoke workflows are never sent twice. Retries back
+    off by backoff * 2^n seconds. Once retries are used up the last response
+    is returned as is
+    """
+    kwds = dict(total=retries, connect=retries, read=retries, status=retries,
+        backoff_factor=backoff, status_forcelist=[500, 502, 503, 504], raise_on_status=False)
+    try:
+        retry = Retry(allowed_methods=frozenset(['GET', 'HEAD']), **kwds)
+    except TypeError:
+        #urllib3 < 1.26
+        retry = Retry(method_whitelist=frozenset(['GET', 'HEAD']), **kwds)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class MetaCache(object):
+    """
+    LRU cache of API records, bounded to max_entries. Records marked
+    immutable never expire, the others expire after ttl seconds. Values are
+    copied in and out, callers are free to modify what they get
+    """
+    def __init__(self, max_entries=10000, ttl=2.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or (entry[0] is not None and entry[0] < time.time()):
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+        return copy.deepcopy(entry[1])
+
+    def put(self, key, value, immutable=False):
+        entry = (None if immutable else time.time() + self.ttl, copy.deepcopy(value))
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return { 'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions, 'entries' : len(self.entries) }
 
-    def __init__(self, url, api_key, path_mapping={}):
+class RemoteGalaxy(object):
+    """
+    Client of the Galaxy API. All calls share one keep-alive session
+    (see galaxy_session). timeout is the (connect, read) timeout in seconds
+    of every request. Batches of independent calls (see map) are fanned
+    out over at most `workers` threads, never more than the connection pool.
+    Dataset, provenance and job records are cached (see MetaCache): for
+    good once they reach a terminal state, for cache_ttl seconds before
+    """
+    def __init__(self, url, api_key, path_mapping={}, pool_size=10, retries=3, backoff=0.5, timeout=(10, 120), workers=None,
+        cache_size=10000, cache_ttl=2.0):
         self.url = url
         self.api_key = api_key
         self.path_mapping = path_mapping
+        self.timeout = timeout
+        self.session = galaxy_session(pool_size=pool_size, retries=retries, backoff=backoff)
+        self.workers = min(workers, pool_size) if workers is not None else pool_size
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.cache = MetaCache(max_entries=cache_size, ttl=cache_ttl)
+
+    def cached_get(self, path, params={}, immutable=lambda record: False):
+        """
+        get through the cache. immutable tells whether a record will never
+        change, error responses are not cached
+        """
+        key = (path, tuple(sorted(params.items())))
+        record = self.cache.get(key)
+        if record is None:
+            record = self.get(path, params)
+            if isinstance(record, dict) and 'err_msg' not in record:
+                self.cache.put(key, record, immutable=immutable(record))
+        return record
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def map(self, func, items):
+        """
+        Calls func on every item concurrently, returns the results in order.
+        func must not call map itself: it would wait on the pool it runs on
+        """
+        items = list(items)
+        if len(items) < 2 or self.workers < 2:
+            return list(func(i) for i in items)
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+        return self.pool.map(func, items)
+
+    def close(self):
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        self.session.close()
 
     def get(self, path, params = {}):
         c_url = self.url + path
+        params = dict(params)
         params['key'] = self.api_key
-        req = requests.get(c_url, params=params)
+        req = self.session.get(c_url, params=params, timeout=self.timeout)
         return req.json()
 
     def post(self, path, payload, params={}):
         c_url = self.url + path
+        params = dict(params)
         params['key'] = self.api_key
         logging.debug("POSTING: %s %s" % (c_url, json.dumps(payload)))
-        req = requests.post(c_url, data=json.dumps(payload), params=params, headers = {'Content-Type': 'application/json'} )
+        req = self.session.post(c_url, data=json.dumps(payload), params=params, headers = {'Content-Type': 'application/json'}, timeout=self.timeout)
         print req.text
         return req.json()
 
@@ -557,35 +712,167 @@ class RemoteGalaxy(object):
         c_url = self.url + path
         if params is None:
             params = {}
+        params = dict(params)
         params['key'] = self.api_key
         logging.debug("POSTING: %s %s" % (c_url, json.dumps(payload)))
-        req = requests.post(c_url, data=json.dumps(payload), params=params, headers = {'Content-Type': 'application/json'} )
+        req = self.session.post(c_url, data=json.dumps(payload), params=params, headers = {'Content-Type': 'application/json'}, timeout=self.timeout)
         return req.text
 
-    def download_handle(self, path):
+    def download_handle(self, path, headers=None):
         url = self.url + path
         logging.info("Downloading: %s" % (url))
         params = {}
         params['key'] = self.api_key
-        r = requests.get(url, params=params, stream=True)
+        r = self.session.get(url, params=params, stream=True, timeout=self.timeout, headers=headers)
         return r
 
-    def download(self, path, dst):
-        r = self.download_handle(path)
-        dsize = 0L
+    def download(self, path, dst, buffer_size=DOWNLOAD_BUFFER, segments=1, segment_min=SEGMENT_MIN, checksum=None, attempts=5):
+        """
+        Downloads to a file handle, or to a path. Downloads to a path go to
+        <dst>.part first, which is renamed to dst once complete (and, if a
+        checksum (algorithm, hexdigest) is given, verified). Interrupted
+        transfers are resumed with Range requests, from a .part left by an
+        earlier call too: <dst>.part.json records the path, size and ETag
+        the .part was downloaded from, and it is only resumed while they
+        still match. Files of at least segment_min bytes are fetched as
+        `segments` concurrent ranges if the server supports them
+        """
         if hasattr(dst, 'write'):
-            for chunk in r.iter_content(chunk_size=1024):
+            r = self.download_handle(path)
+            r.raise_for_status()
+            dsize = 0L
+            for chunk in r.iter_content(chunk_size=buffer_size):
                 if chunk:
                     dst.write(chunk)
                     dsize += len(chunk)
+            logging.info("Downloaded: %s bytes" % (dsize))
+            return dsize
+
+        part = dst + ".part"
+        info = part_info(part)
+        if info is None or info.get('path', None) != path:
+            #left by the download of something else, or without a record of what it holds
+            remove_part(part)
+        size = None
+        if segments > 1:
+            r = self.download_handle(path, headers={'Range' : 'bytes=0-0'})
+            if r.status_code == 206 and '/' in r.headers.get('Content-Range', ''):
+                size = long(r.headers['Content-Range'].split('/')[-1])
+            r.close()
+        if size is not None and size >= segment_min:
+            remove_part(part)
+            with open(part, "wb") as handle:
+                handle.truncate(size)
+            step = (size + segments - 1) / segments
+            ranges = list( (s, min(s + step, size)) for s in range(0, size, step) )
+            #its own pool, download_many may already be running on self.pool
+            pool = ThreadPool(len(ranges))
+            try:
+                pool.map(lambda rng: self.download_range(path, part, rng[0], rng[1], buffer_size, attempts), ranges)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            with open(dst, "wb") as handle:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:
-                        handle.write(chunk)
-                        handle.flush()
-                        dsize += len(chunk)
+            self.download_range(path, part, None, None, buffer_size, attempts)
+        dsize = os.path.getsize(part)
+        if checksum is not None:
+            digest = file_digest(part, checksum[0])
+            if digest != checksum[1].lower():
+                remove_part(part)
+                raise Exception("Checksum mismatch downloading %s: %s %s != %s" % (path, checksum[0], digest, checksum[1]))
+        os.rename(part, dst)
+        remove_part(part)
         logging.info("Downloaded: %s bytes" % (dsize))
+        return dsize
+
+    def download_range(self, path, part, start, end, buffer_size, attempts):
+        """
+        Writes bytes [start, end) of path into the file part, or the whole
+        file resuming from the end of part if start is None. Retries
+        interrupted transfers from where they stopped. A whole file download
+        records what it is fetching in <part>.json, and starts over if the
+        file changed since
+        """
+        whole = start is None
+        for attempt in range(attempts):
+            if whole:
+                info = part_info(part) or {}
+                offset = os.path.getsize(part) if os.path.exists(part) else 0L
+                headers = None
+                if offset > 0:
+                    headers = {'Range' : 'bytes=%d-' % (offset)}
+                    if info.get('etag', None) is not None:
+                        #the server sends the whole file if it changed
+                        headers['If-Range'] = info['etag']
+            else:
+                offset = start
+                headers = {'Range' : 'bytes=%d-%d' % (start, end - 1)}
+            try:
+                r = self.download_handle(path, headers=headers)
+                if r.status_code == 416 and whole:
+                    r.close()
+                    #a 416 should say how long the file is, otherwise go by the size recorded
+                    total = content_total(r)
+                    if total is None:
+                        total = info.get('size', None)
+                    if total == offset:
+                        #the .part is already complete
+                        return
+                    logging.info("Download of %s doesn't match its .part, starting over" % (path))
+                    remove_part(part)
+                    continue
+                r.raise_for_status()
+                if headers is not None and r.status_code != 206:
+                    if not whole:
+                        raise Exception("Server ignored range request for %s" % (path))
+                    #no range support (or the file changed), start over
+                    offset = 0L
+                if whole and offset > 0:
+                    etag = r.headers.get('ETag', None)
+                    if content_total(r) != info.get('size', None) or \
+                        (etag is not None and info.get('etag', None) is not None and etag != info['etag']):
+                        logging.info("Download of %s doesn't match its .part, starting over" % (path))
+                        r.close()
+                        remove_part(part)
+                        continue
+                elif whole:
+                    with open(part + ".json", "w") as handle:
+                        handle.write(json.dumps({ "path" : path, "size" : content_total(r), "etag" : r.headers.get('ETag', None) }))
+                expected = long(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+                received = 0L
+                with open(part, "r+b" if os.path.exists(part) else "wb") as handle:
+                    handle.seek(offset)
+                    if whole:
+                        handle.truncate()
+                    for chunk in r.iter_content(chunk_size=buffer_size):
+                        if chunk:
+                            handle.write(chunk)
+                            received += len(chunk)
+                            if not whole:
+                                start += len(chunk)
+                if expected is not None and received < expected:
+                    #urllib3 doesn't complain about bodies cut short
+                    raise requests.exceptions.ConnectionError("Connection closed after %d of %d bytes" % (received, expected))
+                return
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout), e:
+                if attempt + 1 == attempts:
+                    raise
+                logging.info("Download of %s interrupted, resuming: %s" % (path, e))
+                time.sleep(min(2 ** attempt, 30))
+        raise Exception("Download of %s did not complete in %d attempts" % (path, attempts))
+
+    def download_many(self, downloads, **kwds):
+        """
+        Downloads many files concurrently. downloads is a list of (path, dst)
+        pairs, or (path, dst, checksum) triples; kwds are passed to download.
+        Returns the sizes of the files
+        """
+        def fetch(d):
+            args = dict(kwds)
+            if len(d) > 2:
+                args['checksum'] = d[2]
+            return self.download(d[0], d[1], **args)
+        return self.map(fetch, downloads)
 
     def create_library(self, name):
         lib_create_data = {'name' : name}
@@ -615,10 +902,17 @@ class RemoteGalaxy(object):
         return self.get("/api/libraries/%s/contents/%s" % (library_id, ldda_id))
 
     def get_hda(self, history, hda):
-        return self.get("/api/histories/%s/contents/%s" % (history, hda))
+        return self.cached_get("/api/histories/%s/contents/%s" % (history, hda), immutable=dataset_done)
+
+    def get_hdas(self, history, hdas):
+        """
+        Returns a dict mapping each hda id to its metadata
+        """
+        hdas = list(hdas)
+        return dict(zip(hdas, self.map(lambda h: self.get_hda(history, h), hdas)))
 
     def get_dataset(self, id, src='hda' ):
-        return self.get("/api/datasets/%s?hda_ldda=%s" % (id, src))
+        return self.cached_get("/api/datasets/%s?hda_ldda=%s" % (id, src), immutable=dataset_done)
 
     def download_hda(self, history, hda, dst):
         meta = self.get_hda(history, hda)
@@ -634,10 +928,11 @@ class RemoteGalaxy(object):
         return self.get("/api/histories/%s/contents?details=all" % (history))
 
     def get_provenance(self, history, hda, follow=False):
+        #the job that made a dataset never changes
         if follow:
-            return self.get("/api/histories/%s/contents/%s/provenance" % (history, hda), {"follow" : True})
+            return self.cached_get("/api/histories/%s/contents/%s/provenance" % (history, hda), {"follow" : True}, immutable=lambda p: True)
         else:
-            return self.get("/api/histories/%s/contents/%s/provenance" % (history, hda))
+            return self.cached_get("/api/histories/%s/contents/%s/provenance" % (history, hda), immutable=lambda p: True)
 
     def add_workflow(self, wf):
         self.post("/api/workflows/upload", { 'workflow' : wf } )
@@ -649,18 +944,22 @@ class RemoteGalaxy(object):
         return self.post("/api/workflows", request, params={'step_details' : True} )
 
     def get_job(self, jid):
-        return self.get("/api/jobs/%s" % (jid), {'full' : True} )
+        return self.cached_get("/api/jobs/%s" % (jid), {'full' : True}, immutable=lambda j: j.get('state', None) in JOB_TERMINAL_STATES)
 
-    def library_paste_file(self, library_id, library_folder_id, name, datapath, uuid=None, metadata=None):
+    def map_path(self, datapath):
+        """
+        The path of a local file inside the Galaxy container
+        """
         datapath = os.path.abspath(datapath)
-        found = False
         for ppath, dpath in self.path_mapping.items():
             if datapath.startswith(ppath):
-                datapath = os.path.join(dpath, os.path.relpath(datapath, ppath))
-                found = True
-                break
-        if len(self.path_mapping) > 0 and not found:
+                return os.path.join(dpath, os.path.relpath(datapath, ppath))
+        if len(self.path_mapping) > 0:
             raise Exception("Path %s not in mounted lib_data directories (%s)" % (datapath, ",".join(self.path_mapping.keys())))
+        return datapath
+
+    def library_paste_file(self, library_id, library_folder_id, name, datapath, uuid=None, metadata=None):
+        datapath = self.map_path(datapath)
         data = {}
         data['folder_id'] = library_folder_id
         data['file_type'] = 'auto'
@@ -679,6 +978,292 @@ class RemoteGalaxy(object):
         print libset
         return libset[0]
 
+    def library_paste_files(self, library_id, library_folder_id, files):
+        """
+        Pastes many files into a library folder. files is a list of dicts with
+        'name', 'datapath' and optionally 'uuid' and 'metadata'. Files named
+        after their basename with no uuid or metadata are pasted together in
+        one request (Galaxy names pasted paths after their basename and takes
+        a single uuid per request), the rest are pasted concurrently one per
+        request. Returns the new library datasets in the order of files
+        """
+        out = [None] * len(files)
+        bulk = []
+        single = []
+        for i, f in enumerate(files):
+            if f.get('uuid', None) is None and f.get('metadata', None) is None and f['name'] == os.path.basename(f['datapath']):
+                bulk.append(i)
+            else:
+                single.append(i)
+        if len(bulk) == 1:
+            single.append(bulk.pop())
+        if len(bulk):
+            data = {}
+            data['folder_id'] = library_folder_id
+            data['file_type'] = 'auto'
+            data['upload_option'] = 'upload_paths'
+            data['create_type'] = 'file'
+            data['link_data_only'] = 'link_to_files'
+            data['filesystem_paths'] = "\n".join(self.map_path(files[i]['datapath']) for i in bulk)
+            logging.info("Pasting %d files" % (len(bulk)))
+            libset = self.post("/api/libraries/%s/contents" % library_id, data)
+            if not isinstance(libset, list) or len(libset) != len(bulk):
+                raise Exception("Failed to paste files: %s" % (str(libset)))
+            for i, ld in zip(bulk, libset):
+                out[i] = ld
+        def paste(i):
+            f = files[i]
+            return self.library_paste_file(library_id, library_folder_id, f['name'], f['datapath'],
+                uuid=f.get('uuid', None), metadata=f.get('metadata', None))
+        for i, ld in zip(single, self.map(paste, single)):
+            out[i] = ld
+        return out
+
+    def library_folder_contents(self, folder_id):
+        """
+        The datasets and folders in a library folder, including the state of
+        each dataset
+        """
+        return self.get("/api/folders/%s/contents" % (folder_id)).get('folder_contents', [])
+
+    def library_wait(self, library_id, library_folder_id, ids, timeout=600, poll_min=1.0, poll_max=30.0):
+        """
+        Waits for pasted library datasets to be loaded, with one listing of
+        the folder per poll. The poll interval resets to poll_min whenever a
+        dataset finishes and grows while nothing changes. Raises an Exception
+        if a dataset fails, or isn't loaded within timeout seconds
+        """
+        pending = set(ids)
+        interval = poll_min
+        deadline = time.time() + timeout
+        while True:
+            states = dict( (c['id'], c.get('state', None)) for c in self.library_folder_contents(library_folder_id) if c['id'] in pending )
+            missing = list(i for i in pending if states.get(i, None) is None)
+            for i, d in zip(missing, self.map(lambda i: self.library_get_contents(library_id, i), missing)):
+                states[i] = d.get('state', None)
+            errors = list(i for i in pending if states[i] == 'error')
+            if len(errors):
+                raise Exception("Data loading Error: %s" % (",".join(errors)))
+            done = set(i for i in pending if states[i] == 'ok')
+            pending = pending - done
+            if len(pending) == 0:
+                return
+            if time.time() > deadline:
+                raise Exception("Data loading timed out: %s" % (",".join(sorted(pending))))
+            logging.debug("Data loading: %d of %d pending" % (len(pending), len(ids)))
+            interval = poll_min if len(done) else min(interval * 2, poll_max)
+            time.sleep(min(interval, max(deadline - time.time(), 0)))
+
+
+
+class LibraryIndex(object):
+    """
+    Persistent map from dataset uuids and content digests to the library
+    datasets they were already imported as, so inputs are pasted into a
+    library only once. Entries are kept per Galaxy url and library, and are
+    checked against a listing of the library folder (validate) before use:
+    datasets that are gone or failed are forgotten
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(DEFAULT_CONFIG, "library_index.json")
+        self.path = path
+        self.libraries = {}
+        if os.path.exists(path):
+            with open(path) as handle:
+                self.libraries = json.loads(handle.read())
+
+    def library(self, rg, library_id):
+        return self.libraries.setdefault("%s|%s" % (rg.url, library_id), {'uuid' : {}, 'digest' : {}})
+
+    def validate(self, rg, library_id, folder_contents):
+        """
+        Forget the entries missing from folder_contents, or failed or deleted in
+        it. The listing has to be taken after every entry was added, or fresh
+        entries are lost
+        """
+        lib = self.library(rg, library_id)
+        valid = set(c['id'] for c in folder_contents if c.get('state', 'ok') not in ['error', 'discarded'] and not c.get('deleted', False))
+        for field in ['uuid', 'digest']:
+            for k, v in lib[field].items():
+                if v not in valid:
+                    del lib[field][k]
+
+    def find(self, rg, library_id, uuid=None, digest=None):
+        lib = self.library(rg, library_id)
+        if uuid is not None and uuid in lib['uuid']:
+            return lib['uuid'][uuid]
+        if digest is not None and digest in lib['digest']:
+            return lib['digest'][digest]
+        return None
+
+    def add(self, rg, library_id, ldda_id, uuid=None, digest=None):
+        lib = self.library(rg, library_id)
+        if uuid is not None:
+            lib['uuid'][uuid] = ldda_id
+        if digest is not None:
+            lib['digest'][digest] = ldda_id
+
+    def save(self):
+        d = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(d):
+            os.makedirs(d)
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "w") as handle:
+            handle.write(json.dumps(self.libraries))
+        os.rename(tmp, self.path)
+
+
+def pool_names(name, instances):
+    if instances == 1:
+        return [name]
+    return list("%s_%d" % (name, i) for i in range(instances))
+
+def run_up_pool(instances=1, name="galaxy", port=8080, work_dir=None, hold=False, **kwds):
+    """
+    Starts `instances` Galaxy containers at once, named <name>_<i>, on ports
+    port+i, each with its own <work_dir>/<name>_<i>. A single instance keeps
+    the plain name, port and work_dir. Returns the RemoteGalaxy of each
+    """
+    if instances == 1:
+        return [run_up(name=name, port=port, work_dir=work_dir, hold=hold, **kwds)]
+    if work_dir is not None and not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    def up(i):
+        n = pool_names(name, instances)[i]
+        return run_up(name=n, port=int(port) + i, work_dir=os.path.join(work_dir, n) if work_dir is not None else None,
+            hold=hold, **kwds)
+    pool = ThreadPool(instances)
+    try:
+        return pool.map(up, range(instances))
+    finally:
+        pool.close()
+        pool.join()
+
+def run_down_pool(instances=1, name="galaxy", **kwds):
+    for n in pool_names(name, instances):
+        run_down(name=n, **kwds)
+
+
+class GalaxyMember(object):
+    def __init__(self, name, rg):
+        self.name = name
+        self.rg = rg
+        #tasks dispatched here and not finished yet
+        self.load = 0
+        self.healthy = True
+        self.draining = False
+        self.library_id = None
+        self.folder_id = None
+        #workflows uploaded to this Galaxy
+        self.workflows = set()
+
+class GalaxyPool(object):
+    """
+    Dispatches tasks across several Galaxy instances. With the "hash" policy
+    a task goes to the instance with the highest affinity (e.g. the number of
+    its inputs already uploaded there), or else to the one its key (e.g. its
+    largest input) hashes to on a consistent hash ring, so the same inputs keep
+    landing where they were already uploaded. An instance more than `spill`
+    times over the average load is passed over for the next one. With
+    "least" a task goes to the least loaded instance. Unhealthy or draining
+    instances get no new tasks
+    """
+    def __init__(self, members, policy="hash", spill=1.25, vnodes=64, health_timeout=5):
+        if policy not in ["hash", "least"]:
+            raise Exception("Unknown dispatch policy: %s" % (policy))
+        self.members = members
+        self.policy = policy
+        self.spill = spill
+        self.health_timeout = health_timeout
+        self.lock = threading.Condition()
+        self.ring = []
+        for m in members:
+            for v in range(vnodes):
+                self.ring.append( (ring_hash("%s#%d" % (m.name, v)), m) )
+        self.ring.sort(key=lambda x: x[0])
+        self.ring_keys = list(h for h, m in self.ring)
+
+    def get(self, name):
+        for m in self.members:
+            if m.name == name:
+                return m
+        return None
+
+    def available(self):
+        return list(m for m in self.members if m.healthy and not m.draining)
+
+    def pick(self, key=None, affinity=None):
+        members = self.available()
+        if len(members) == 0:
+            return None
+        if self.policy == "least":
+            return min(members, key=lambda m: m.load)
+        bound = self.spill * (sum(m.load for m in members) + 1) / len(members)
+        if affinity is not None:
+            for m in sorted(members, key=lambda m: -affinity.get(m.name, 0)):
+                if affinity.get(m.name, 0) == 0:
+                    break
+                if m.load + 1 <= max(bound, 1):
+                    return m
+        if key is None:
+            return min(members, key=lambda m: m.load)
+        start = bisect.bisect(self.ring_keys, ring_hash(key))
+        for i in range(len(self.ring)):
+            m = self.ring[(start + i) % len(self.ring)][1]
+            if m in members and m.load + 1 <= max(bound, 1):
+                return m
+        return min(members, key=lambda m: m.load)
+
+    def acquire(self, key=None, affinity=None):
+        """
+        Picks an instance for a task and counts the task against it, waiting
+        while no instance is available. affinity maps instance names to how
+        many of the task's inputs each already holds
+        """
+        with self.lock:
+            while True:
+                m = self.pick(key, affinity)
+                if m is not None:
+                    m.load += 1
+                    return m
+                self.lock.wait(1.0)
+
+    def release(self, member):
+        with self.lock:
+            member.load -= 1
+            self.lock.notify_all()
+
+    def drain(self, name):
+        """
+        Sends no more tasks to an instance, returns it so the caller can shut
+        it down once its load is 0
+        """
+        with self.lock:
+            m = self.get(name)
+            if m is None:
+                raise Exception("Unknown Galaxy: %s" % (name))
+            m.draining = True
+            return m
+
+    def check(self):
+        """
+        Pings every instance and marks it healthy or not
+        """
+        for m in self.members:
+            try:
+                res = m.rg.session.get(m.rg.url + "/api/version", timeout=self.health_timeout)
+                healthy = res.status_code / 100 != 5
+            except requests.exceptions.RequestException:
+                healthy = False
+            if healthy != m.healthy:
+                logging.warning("Galaxy %s is %s" % (m.name, "healthy" if healthy else "unhealthy"))
+            with self.lock:
+                m.healthy = healthy
+                self.lock.notify_all()
+
+def ring_hash(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
 
 
 def run_down(name="galaxy", host=None, rm=False, config_dir=DEFAULT_CONFIG, sudo=False):
@@ -1011,7 +1596,8 @@ def add_warp_run_commands(subparsers):
     parser_up.add_argument("--sudo", action="store_true", default=False)
     parser_up.add_argument("--hold", action="store_true", default=False)
 
-    parser_up.set_defaults(func=run_up)
+    parser_up.add_argument("--instances", type=int, default=1, help="Number of Galaxy containers, on consecutive ports")
+    parser_up.set_defaults(func=run_up_pool)
 
     parser_down = subparsers.add_parser('down')
     parser_down.add_argument("-n", "--name", default="galaxy")
@@ -1021,7 +1607,8 @@ def add_warp_run_commands(subparsers):
     parser_down.add_argument("--sudo", action="store_true", default=False)
     parser_down.add_argument("-v", action="store_true", default=False)
     parser_down.add_argument("-vv", action="store_true", default=False)
-    parser_down.set_defaults(func=run_down)
+    parser_down.add_argument("--instances", type=int, default=1)
+    parser_down.set_defaults(func=run_down_pool)
 
     parser_status = subparsers.add_parser('status')
     parser_status.add_argument("-n", "--name", default="galaxy")